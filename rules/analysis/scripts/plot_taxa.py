@@ -1,10 +1,16 @@
 #!/usr/bin env python
+"""Taxonomy composition for QC report (MultiQC custom content).
 
+The feature table is collapsed to all taxonomy levels in one pass: counts are first summed per unique taxonomy
+string, and each level is a sparse group-by of these. Only the top N taxa per level are kept, the rest is
+summed into "Other". The section is a samples x taxa table (default) or a stacked bar plot per level.
+"""
 import sys
 import os
 import argparse
 import glob
 import warnings
+import collections
 from itertools import cycle
 
 warnings.filterwarnings("ignore", message="numpy.dtype size changed")
@@ -12,11 +18,77 @@ warnings.filterwarnings("ignore", message="numpy.dtype size changed")
 import yaml
 import pandas as pd
 import numpy as np
+from scipy import sparse
 
+TAXA_NAMES = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
+LEVELS = ['Phylum', 'Class', 'Order', 'Genus']
 
-def taxa_yaml(tables, group=None):
-    if group is not None and group in tab.columns:
-        group = tab.pop(group)
+
+def indicator(codes, n_groups):
+    """Sparse groups x items indicator matrix of group codes.
+    """
+    return sparse.csr_matrix((np.ones(len(codes)), (codes, np.arange(len(codes)))), shape=(n_groups, len(codes)))
+
+
+def collapse_levels(X, taxonomy, sample_ids, levels=range(1, 8)):
+    """Collapse a sparse features x samples count matrix to taxonomy levels.
+
+    `taxonomy` is a list of ranks per feature, missing ranks are padded with `__` (as qiime2 taxa collapse).
+    Returns a dict of level: samples x taxa dataframe (the level-<n>.csv layout of qiime2 taxa barplot).
+    """
+    full = [';'.join(i.strip() for i in t) for t in taxonomy]
+    codes, uniq = pd.factorize(pd.Series(full))
+    X = indicator(codes, len(uniq)).dot(sparse.csr_matrix(X)).tocsr()
+    ranks = [t.split(';') for t in uniq]
+    collapsed = {}
+    for level in levels:
+        labels = [';'.join((r + ['__'] * level)[:level]) for r in ranks]
+        level_codes, level_uniq = pd.factorize(pd.Series(labels))
+        C = indicator(level_codes, len(level_uniq)).dot(X)
+        collapsed[level] = pd.DataFrame(C.T.toarray(), index=pd.Index(sample_ids, name='index'), columns=level_uniq)
+    return collapsed
+
+
+def top_taxa(tab, n=20):
+    """Keep the `n` most abundant taxa (columns) and sum the rest into "Other".
+    """
+    order = tab.sum(0).sort_values(ascending=False).index
+    top = tab[order[:n]].copy()
+    if len(order) > n:
+        top['Other'] = tab[order[n:]].sum(1)
+    return top
+
+
+def short_names(labels):
+    """Lowest named rank of taxonomy labels, full label if the short name is not unique.
+    """
+    short = []
+    for label in labels:
+        names = [i.split('__')[-1].strip() for i in label.split(';')]
+        names = [i for i in names if i]
+        short.append(names[-1] if names else label)
+    counts = pd.Series(short).value_counts()
+    return [s if counts[s] == 1 else l for s, l in zip(short, labels)]
+
+
+def level_tables(tables, top_n=20):
+    """Top `top_n` taxa (+ Other) per level with short taxa names, as integer counts.
+    """
+    out = {}
+    for label, tab in tables.items():
+        tab = top_taxa(tab, n=top_n)
+        tab.columns = short_names(list(tab.columns))
+        out[label] = tab.round().astype(int)
+    return out
+
+
+def taxa_yaml(tables, top_n=20, plot_type='table'):
+    """MultiQC custom content section of the top taxa per level.
+
+    `table` is a single samples x taxa table with one column namespace per level (only the first level
+    is shown by default, the others are available in the column chooser). `bargraph` is a stacked bar
+    plot with one dataset per level.
+    """
     default_colors = ["#7cb5ec",
                       "#434348",
                       "#90ed7d",
@@ -27,22 +99,40 @@ def taxa_yaml(tables, group=None):
                       "#2b908f",
                       "#f45b5b",
                       "#91e8e1"]
-    
+
+    tables = level_tables(tables, top_n=top_n)
+    section = {}
+    section["id"] = "taxonomy"
+    section["section_name"] = "QIIME2"
+    section["description"] = ". Summary of reads falling within specific taxonomies (top {} per level).".format(top_n)
+    section["plot_type"] = plot_type
+
+    if plot_type == 'table':
+        headers = {}
+        data = collections.defaultdict(dict)
+        for i, (label, tab) in enumerate(tables.items()):
+            columns = ['{}: {}'.format(label, k) for k in tab.columns]
+            for col, k in zip(columns, tab.columns):
+                headers[col] = {"title": k, "namespace": label, "format": "{:,.0f}", "scale": "Blues",
+                                "hidden": i > 0}
+            for s, row in zip(tab.index, tab.values):
+                data[str(s)].update((col, int(v)) for col, v in zip(columns, row) if v > 0)
+        section["pconfig"] = {"id": "taxonomy", "title": "Taxonomy", "col1_header": "Sample"}
+        section["headers"] = headers
+        section["data"] = dict(data)
+        return section
+
     data_labels = []
     data = []
     keys = {}
     for label, tab in tables.items():
         cycle_colors = cycle(default_colors)
-        tab = tab.loc[:,tab.columns.str.contains(';')]
-        tab.columns = [i.split('__')[-1].strip() for i in list(tab.columns)]
-        order = tab.sum(0).argsort()[::-1]
-        tab = tab.iloc[:,order]
-        data.append(tab.T.to_dict())
+        data.append({str(s): {k: int(v) for k, v in row.items() if v > 0} for s, row in tab.iterrows()})
         data_labels.append(label)
-        for i, k in enumerate(tab.index):
-            color = next(cycle_colors)
-            keys[k] = {"color": color, "name": k}
-    
+        for k in tab.columns:
+            if k not in keys:
+                keys[k] = {"color": next(cycle_colors), "name": k}
+
     # Config for the plot
     pconfig = {
         "id": "taxonomy",
@@ -50,13 +140,6 @@ def taxa_yaml(tables, group=None):
         "ylab": "# Reads",
         'data_labels': data_labels,
     }
-
-    section = {}
-    section["id"] = "taxonomy"
-    section["section_name"] = "QIIME2"
-    section["description"] = ". Summary of reads falling within specific taxonomies."
-    section["plot_type"] = "bargraph"
-
     section["pconfig"] = pconfig
     section["categories"] = keys
     section["data"] = data
@@ -66,41 +149,54 @@ def taxa_yaml(tables, group=None):
 
 def argparser():
     parser = argparse.ArgumentParser(description="Taxonomy composition figure for QC report")
-    parser.add_argument("input")
+    parser.add_argument("input", nargs="?", help="directory of level-<n>.csv files (exported qiime2 taxa barplot)")
+    parser.add_argument("--biom", help="biom table with taxonomy observation metadata, used instead of input")
+    parser.add_argument("--csv-dir", help="also write collapsed level-<n>.csv files of --biom to this directory")
+    parser.add_argument("--top-n", help="number of taxa per level, others are summed", type=int, default=20)
+    parser.add_argument("--plot-type", help="MultiQC section type", choices=["table", "bargraph"], default="table")
     parser.add_argument("--sample-info", help="Optional sample sheet. Will subset expr table if needed", dest="samples")
-    parser.add_argument("--sample-group", help="Optional sample-group name. Will stratify on sample-group if used.", dest="group")
-    #parser.add_argument("--taxonomy-db", help="Taxonomy database.", dest="db", required=True)
-    parser.add_argument("-o ", "--output", default="taxa_mqc.yaml", help="Output filename. Will default to biotypes_mqc.yaml")
+    parser.add_argument("--sample-group", help="Optional sample-group name. Will sum samples per sample-group if used.", dest="group")
+    parser.add_argument("-o ", "--output", default="taxa_mqc.yaml", help="Output filename. Will default to taxa_mqc.yaml")
 
     args = parser.parse_args()
+    if args.input is None and args.biom is None:
+        parser.error("input or --biom is required")
     return args
 
 
 if __name__ == "__main__":
-    taxa_names = ["Kingdom", "Phylum", "Class", "Order", "Family", "Genus", "Species"]
     args = argparser()
-    patt = os.path.join(args.input, '*.csv')
-    tables =  {}
-    LEVELS = ['Phylum', 'Order', 'Genus', 'Class']
-    for fn in glob.glob(patt):
-        level = os.path.basename(fn).split('.csv')[0][-1]
-        label = taxa_names[int(level) - 1]
-        if label in LEVELS:
+    tables = {}
+    if args.biom:
+        import biom
+        T = biom.load_table(args.biom)
+        taxonomy = [T.metadata(i, axis='observation')['taxonomy'] for i in T.ids('observation')]
+        collapsed = collapse_levels(T.matrix_data, taxonomy, T.ids('sample'))
+        if args.csv_dir:
+            os.makedirs(args.csv_dir, exist_ok=True)
+            for level, tab in collapsed.items():
+                tab.to_csv(os.path.join(args.csv_dir, 'level-{}.csv'.format(level)))
+        for level, tab in collapsed.items():
+            tables[TAXA_NAMES[level - 1]] = tab
+    else:
+        for fn in glob.glob(os.path.join(args.input, '*.csv')):
+            level = os.path.basename(fn).split('.csv')[0][-1]
             tab = pd.read_csv(fn, sep=",", index_col=0)
             tab.index = tab.index.astype(str)
-            tables[label] = tab
+            tables[TAXA_NAMES[int(level) - 1]] = tab.loc[:, tab.columns.str.contains('__')]
+
     if args.samples is not None:
         S = pd.read_csv(args.samples, sep="\t", index_col=0)
         S.index = S.index.astype(str)
-        if not tab.columns.isin(S.index).all():
-            raise ValueError("missing samples in sample info!")
-        for tab in tables.values():
-            tab = tab.loc[S.columns, :]
+        for label, tab in tables.items():
+            if not tab.index.isin(S.index).all():
+                raise ValueError("missing samples in sample info!")
+            if args.group is not None and args.group in S.columns:
+                tab = tab.groupby(S.loc[tab.index, args.group]).sum()
+            tables[label] = tab
 
-    ordered_tables = {}
-    for k in LEVELS:
-        ordered_tables[k] = tables[k]
-    section = taxa_yaml(ordered_tables, group=args.group)
+    ordered_tables = {k: tables[k] for k in LEVELS}
+    section = taxa_yaml(ordered_tables, top_n=args.top_n, plot_type=args.plot_type)
 
     with open(args.output, "w") as fh:
-        yaml.dump(section, fh, default_flow_style=False, sort_keys=False)
+        yaml.dump(section, fh, default_flow_style=None, sort_keys=False)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""Interleave paired fastq files to stdout.
+
+Usage: interleave_fastq.py --R1 L001_R1.fastq.gz L002_R1.fastq.gz --R2 L001_R2.fastq.gz L002_R2.fastq.gz > interleaved.fastq
+
+Multiple lanes are concatenated in the given order. R1 and R2 are decompressed concurrently, each by its
+own pigz process (or python gzip, which releases the GIL) read by a reader thread. The reader threads hand
+over large blocks of complete records, and blocks are interleaved with list slicing instead of per record.
+Read pairs are checked to stay in sync (same read id in R1 and R2) at the first and last record of every
+block, a dropped or extra read shifts all later records and is caught at the next block boundary.
+"""
+import sys
+import gzip
+import queue
+import shutil
+import argparse
+import threading
+import subprocess
+
+BLOCK_SIZE = 1 << 20
+
+
+def open_lanes(fnames):
+    """Return a list of binary streams of the (decompressed) fastq files, and the pigz process if used.
+    """
+    if all(fn.endswith('.gz') for fn in fnames) and shutil.which('pigz'):
+        proc = subprocess.Popen(['pigz', '-dc'] + list(fnames), stdout=subprocess.PIPE, bufsize=BLOCK_SIZE)
+        return [proc.stdout], proc
+    return [gzip.open(fn, 'rb') if fn.endswith('.gz') else open(fn, 'rb') for fn in fnames], None
+
+
+def read_blocks(fnames, block_size=BLOCK_SIZE):
+    """Yield the lines (without newlines) of blocks of complete fastq records of the concatenated files.
+    """
+    streams, proc = open_lanes(fnames)
+    rest = b''
+    for fh in streams:
+        with fh:
+            while True:
+                data = fh.read(block_size)
+                if not data:
+                    break
+                lines = (rest + data).split(b'\n')
+                k = (len(lines) - 1) // 4 * 4
+                rest = b'\n'.join(lines[k:])
+                if k:
+                    yield lines[:k]
+    if rest.strip():
+        lines = rest.rstrip(b'\n').split(b'\n')
+        if len(lines) % 4:
+            raise ValueError('truncated fastq record: {}'.format(lines[-(len(lines) % 4)].decode()))
+        yield lines
+    if proc is not None and proc.wait() != 0:
+        raise subprocess.CalledProcessError(proc.returncode, 'pigz')
+
+
+def block_reader(fnames, maxsize=4):
+    """Run `read_blocks` in a thread. Returns a queue of line blocks, ended by None (or an exception).
+    """
+    q = queue.Queue(maxsize)
+
+    def run():
+        try:
+            for lines in read_blocks(fnames):
+                q.put(lines)
+            q.put(None)
+        except Exception as e:
+            q.put(e)
+    threading.Thread(target=run, daemon=True).start()
+    return q
+
+
+def next_block(q):
+    lines = q.get()
+    if isinstance(lines, Exception):
+        raise lines
+    return lines
+
+
+def read_id(header):
+    name = header.split()[0]
+    if name.endswith(b'/1') or name.endswith(b'/2'):
+        name = name[:-2]
+    return name
+
+
+def check_pair(h1, h2, i):
+    if read_id(h1) != read_id(h2):
+        raise ValueError('R1 and R2 out of sync at read pair {}: {} != {}'.format(i, h1.decode(), h2.decode()))
+
+
+def interleave(R1, R2, out):
+    """Write interleaved R1/R2 records to binary stream `out`. Returns the number of read pairs.
+    """
+    q1, q2 = block_reader(R1), block_reader(R2)
+    buf1, buf2 = [], []
+    eof1 = eof2 = False
+    n = 0
+    while True:
+        if not buf1 and not eof1:
+            buf1 = next_block(q1)
+            eof1 = buf1 is None
+            buf1 = buf1 or []
+        if not buf2 and not eof2:
+            buf2 = next_block(q2)
+            eof2 = buf2 is None
+            buf2 = buf2 or []
+        if not buf1 or not buf2:
+            if buf1 or buf2:
+                raise ValueError('R1 and R2 have different number of reads (after {} pairs)'.format(
+                    n + min(len(buf1), len(buf2)) // 4))
+            break
+        k = min(len(buf1), len(buf2))
+        a, b = buf1[:k], buf2[:k]
+        buf1, buf2 = buf1[k:], buf2[k:]
+        check_pair(a[0], b[0], n + 1)
+        check_pair(a[k - 4], b[k - 4], n + k // 4)
+        merged = [None] * (2 * k)
+        for i in range(4):
+            merged[i::8] = a[i::4]
+            merged[4 + i::8] = b[i::4]
+        merged.append(b'')
+        out.write(b'\n'.join(merged))
+        n += k // 4
+    return n
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--R1', help='R1 fastq files (lanes)', nargs='+', required=True)
+    parser.add_argument('--R2', help='R2 fastq files (lanes)', nargs='+', required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    if len(args.R1) != len(args.R2):
+        raise ValueError('number of R1 and R2 files differ')
+    out = sys.stdout.buffer
+    interleave(args.R1, args.R2, out)
+    out.flush()
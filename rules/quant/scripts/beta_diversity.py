@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+"""Core diversity metrics (as qiime2 core-metrics-phylogenetic) with cached distance matrices.
+
+The table is rarefied once and shared by all metrics. Branch presence and abundance are taken from one
+traversal of the tree. Jaccard and unweighted UniFrac are computed as matrix products, Bray-Curtis and
+weighted UniFrac over blocks of sample rows in a process pool.
+
+Distance matrices, PCoA results and alpha diversity vectors are cached in `<output-dir>/cache/<key>`, keyed by a hash
+of the table, tree and sampling depth. Reruns with the same data (e.g. after a metadata change) only redo the
+emperor plots.
+"""
+import os
+import shutil
+import hashlib
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.spatial.distance import cdist
+
+from rarefaction import rarefy, tree_incidence, alpha_metrics
+
+BETA_METRICS = ['bray_curtis', 'jaccard', 'unweighted_unifrac', 'weighted_unifrac']
+ALPHA_METRICS = ['shannon', 'observed_otus', 'faith_pd']
+
+
+def data_key(table, tree, depth, seed=0):
+    """Hash of table counts and ids, tree and rarefaction parameters.
+    """
+    M = table.matrix_data.tocsr()
+    md5 = hashlib.md5()
+    for part in [M.data, M.indices, M.indptr]:
+        md5.update(np.ascontiguousarray(part).tobytes())
+    md5.update('\t'.join(table.ids('observation')).encode())
+    md5.update('\t'.join(table.ids('sample')).encode())
+    md5.update(str(tree).encode())
+    md5.update('{}:{}'.format(depth, seed).encode())
+    return md5.hexdigest()
+
+
+def shared_branch_distance(B, lengths):
+    """Length weighted Jaccard distance of binary samples x branches matrix `B` (unweighted UniFrac / Jaccard).
+    """
+    B = sparse.csr_matrix(B, dtype=float)
+    shared = B.multiply(lengths).dot(B.T).toarray()
+    total = B.dot(lengths)
+    union = total[:, None] + total[None, :] - shared
+    with np.errstate(divide='ignore', invalid='ignore'):
+        D = np.where(union > 0, 1.0 - shared / union, 0.0)
+    np.fill_diagonal(D, 0.0)
+    return D
+
+
+_BETA_DATA = {}
+
+def block_worker(name, metric, start, stop):
+    """cdist of rows start:stop against rows start: of the matrix `name` in the module level `_BETA_DATA`.
+    """
+    M = _BETA_DATA[name]
+    return start, cdist(M[start:stop], M[start:], metric)
+
+
+def blocked_distance(M, metric, threads=1, block_size=64):
+    """Pairwise distances of the rows of a dense matrix, upper triangle blocks spread over a process pool.
+    """
+    n = M.shape[0]
+    _BETA_DATA['M'] = M
+    D = np.zeros((n, n))
+    blocks = [(i, min(n, i + block_size)) for i in range(0, n, block_size)]
+    with mp.Pool(max(1, threads)) as pool:
+        for start, d in pool.starmap(block_worker, [('M', metric, i, j) for i, j in blocks]):
+            D[start:start + d.shape[0], start:] = d
+    _BETA_DATA.clear()
+    return np.triu(D) + np.triu(D, 1).T
+
+
+def core_metrics(table, tree, depth, threads=1, seed=0):
+    """Rarefy `table` to `depth` and compute alpha vectors and beta distance matrices.
+
+    Returns the rarefied biom table, a dict of alpha diversity series and a dict of sample ids and distance matrices.
+    """
+    import biom
+    feature_ids = list(table.ids('observation'))
+    X, keep = rarefy(table.matrix_data.T, depth, seed=seed)
+    sample_ids = [table.ids('sample')[i] for i in keep]
+    used = np.flatnonzero(np.asarray(X.sum(axis=0)).ravel() > 0)
+    X = X[:, used].tocsr()
+    feature_ids = [feature_ids[i] for i in used]
+    A, lengths = tree_incidence(tree, feature_ids)
+    branch_counts = X.dot(A.astype(float))
+    rarefied = biom.Table(X.T, feature_ids, sample_ids)
+
+    dense = X.toarray().astype(float)
+    alpha = alpha_metrics(dense, ALPHA_METRICS, A, lengths)
+    alpha = {m: pd.Series(alpha[i], index=pd.Index(sample_ids, name='sample-id'), name=m)
+             for i, m in enumerate(ALPHA_METRICS)}
+
+    beta = {}
+    beta['jaccard'] = shared_branch_distance(X > 0, np.ones(X.shape[1]))
+    beta['unweighted_unifrac'] = shared_branch_distance(branch_counts > 0, lengths)
+    beta['bray_curtis'] = blocked_distance(dense, 'braycurtis', threads=threads)
+    # non normalized weighted unifrac: sum of branch length x |relative branch abundance difference|
+    W = branch_counts.toarray() / float(depth) * lengths
+    beta['weighted_unifrac'] = blocked_distance(W, 'cityblock', threads=threads)
+    return rarefied, alpha, {m: (sample_ids, D) for m, D in beta.items()}
+
+
+def cached_core_metrics(table, tree, depth, cache_dir, threads=1, seed=0):
+    """Artifacts of `core_metrics`, loaded from `<cache_dir>/<data_key>` if present.
+    """
+    import skbio
+    from skbio.stats.ordination import pcoa
+    from qiime2 import Artifact
+    key_dir = os.path.join(cache_dir, data_key(table, tree, depth, seed))
+    names = (['rarefied_table'] + ['{}_vector'.format(m) for m in ALPHA_METRICS] +
+             ['{}_distance_matrix'.format(m) for m in BETA_METRICS] + ['{}_pcoa_results'.format(m) for m in BETA_METRICS])
+    if all(os.path.exists(os.path.join(key_dir, n + '.qza')) for n in names):
+        print('using cached diversity metrics {}'.format(key_dir))
+        return {n: Artifact.load(os.path.join(key_dir, n + '.qza')) for n in names}
+
+    rarefied, alpha, beta = core_metrics(table, tree, depth, threads=threads, seed=seed)
+    res = {'rarefied_table': Artifact.import_data('FeatureTable[Frequency]', rarefied)}
+    for m, s in alpha.items():
+        res['{}_vector'.format(m)] = Artifact.import_data('SampleData[AlphaDiversity]', s)
+    for m, (ids, D) in beta.items():
+        dm = skbio.DistanceMatrix(D, ids)
+        res['{}_distance_matrix'.format(m)] = Artifact.import_data('DistanceMatrix', dm)
+        res['{}_pcoa_results'.format(m)] = Artifact.import_data('PCoAResults', pcoa(dm))
+    tmp_dir = key_dir + '.tmp'
+    os.makedirs(tmp_dir, exist_ok=True)
+    for n, artifact in res.items():
+        artifact.save(os.path.join(tmp_dir, n + '.qza'))
+    shutil.rmtree(key_dir, ignore_errors=True)
+    os.rename(tmp_dir, key_dir)
+    return res
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', help='FeatureTable[Frequency] artifact', required=True)
+    parser.add_argument('--phylogeny', help='Phylogeny[Rooted] artifact', required=True)
+    parser.add_argument('--metadata', help='sample metadata', required=True)
+    parser.add_argument('--sampling-depth', help='rarefaction depth', type=int, required=True)
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('--threads', help='number of processes', type=int, default=1)
+    parser.add_argument('--cache-dir', help='distance matrix cache (default: <output-dir>/cache)')
+    parser.add_argument('--output-dir', help='output directory', required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    import biom
+    import skbio
+    from qiime2 import Artifact, Metadata
+    from qiime2.plugins import emperor
+
+    args = get_parser().parse_args()
+    table = Artifact.load(args.table).view(biom.Table)
+    tree = Artifact.load(args.phylogeny).view(skbio.TreeNode)
+    metadata = Metadata.load(args.metadata)
+    cache_dir = args.cache_dir or os.path.join(args.output_dir, 'cache')
+    res = cached_core_metrics(table, tree, args.sampling_depth, cache_dir, threads=args.threads, seed=args.seed)
+    os.makedirs(args.output_dir, exist_ok=True)
+    for name, artifact in res.items():
+        artifact.save(os.path.join(args.output_dir, name + '.qza'))
+    for m in BETA_METRICS:
+        viz = emperor.visualizers.plot(res['{}_pcoa_results'.format(m)], metadata).visualization
+        viz.save(os.path.join(args.output_dir, '{}_emperor.qzv'.format(m)))
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+"""Filter and dereplicate paired end reads per sample before dada2.
+
+Reads are filtered with the trimming and quality rules of dada2 filterAndTrim (trim left, truncate at the first
+quality <= trunc-q, discard reads shorter than trunc-len, truncate to trunc-len, discard reads with N, shorter than
+min-len or more expected errors than max-ee). Unlike the fastq path of dada2_paired.R (rm.phix=TRUE), phiX reads are
+not removed, so phiX reads with primer hits can end up as ASVs.
+Passing pairs are reduced to unique forward and reverse sequences with abundances and mean quality profiles, and the
+unique (forward, reverse) pairs with their abundances.
+
+One gzipped binary index `<sample>.derep.gz` is written per sample (little endian, read by dada2_paired.R):
+
+    int32 input reads, int32 passed filter
+    forward and reverse block: int32 n, int32 max length, int32[n] abundances, int32[n] lengths,
+        uint8[n x max length] sequences, float32[n x max length] mean qualities
+    pairs: int32 n, int32[n] forward index, int32[n] reverse index, int32[n] abundances (1-based indexes)
+"""
+import os
+import re
+import gzip
+import glob
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+
+from fastq_io import open_fastq, read_fastq
+
+SUFFIX = '.derep.gz'
+
+
+def filter_read(seq, qual, trim_left=0, trunc_len=0, max_ee=float('inf'), trunc_q=2, min_len=20):
+    """Trimmed (sequence, phred scores) of a read, None if the read does not pass the filter.
+    """
+    seq, q = seq[trim_left:], np.frombuffer(qual.encode(), dtype=np.uint8)[trim_left:].astype(np.int64) - 33
+    low = np.flatnonzero(q <= trunc_q)
+    if len(low):
+        seq, q = seq[:low[0]], q[:low[0]]
+    if trunc_len:
+        end = trunc_len - trim_left
+        if len(seq) < end:
+            return None
+        seq, q = seq[:end], q[:end]
+    if len(seq) < min_len or 'N' in seq:
+        return None
+    if np.sum(10.0 ** (-q / 10.0)) > max_ee:
+        return None
+    return seq, q
+
+
+class Uniques(object):
+    """Unique sequences with abundances and summed quality profiles.
+    """
+    def __init__(self):
+        self.index = {}
+        self.abundance = []
+        self.quals = []
+
+    def add(self, seq, q):
+        i = self.index.get(seq)
+        if i is None:
+            i = self.index[seq] = len(self.abundance)
+            self.abundance.append(0)
+            self.quals.append(np.zeros(len(seq)))
+        self.abundance[i] += 1
+        self.quals[i] += q
+        return i
+
+    def arrays(self):
+        """Sequences, abundances, lengths and mean qualities in decreasing abundance, and the old to new index map.
+        """
+        order = np.argsort(-np.array(self.abundance, dtype=np.int64), kind='stable')
+        seqs = list(self.index.keys())
+        lengths = np.array([len(seqs[i]) for i in order], dtype=np.int32)
+        width = int(lengths.max()) if len(lengths) else 0
+        S = np.full((len(order), width), ord('N'), dtype=np.uint8)
+        Q = np.full((len(order), width), np.nan, dtype=np.float32)
+        for k, i in enumerate(order):
+            S[k, :lengths[k]] = np.frombuffer(seqs[i].encode(), dtype=np.uint8)
+            Q[k, :lengths[k]] = self.quals[i] / self.abundance[i]
+        abundance = np.array(self.abundance, dtype=np.int32)[order]
+        remap = np.empty(len(order), dtype=np.int32)
+        remap[order] = np.arange(len(order))
+        return S, abundance, lengths, Q, remap
+
+
+def dereplicate_pairs(r1_fn, r2_fn, trim_left=(0, 0), trunc_len=(0, 0), max_ee=(float('inf'), float('inf')), trunc_q=2,
+                      min_len=20):
+    """Filter and dereplicate a pair of fastq files. Returns a dict of the index fields (see module doc).
+    """
+    fwd, rev, pairs = Uniques(), Uniques(), {}
+    n_input = 0
+    with open_fastq(r1_fn) as fh1, open_fastq(r2_fn) as fh2:
+        for (h1, s1, p1, q1), (h2, s2, p2, q2) in zip(read_fastq(fh1), read_fastq(fh2)):
+            n_input += 1
+            f = filter_read(s1, q1, trim_left[0], trunc_len[0], max_ee[0], trunc_q, min_len)
+            if f is None:
+                continue
+            r = filter_read(s2, q2, trim_left[1], trunc_len[1], max_ee[1], trunc_q, min_len)
+            if r is None:
+                continue
+            key = (fwd.add(*f), rev.add(*r))
+            pairs[key] = pairs.get(key, 0) + 1
+    derep = {'input': n_input, 'filtered': sum(pairs.values())}
+    for name, uniq in [('F', fwd), ('R', rev)]:
+        S, abundance, lengths, Q, remap = uniq.arrays()
+        derep[name] = {'seqs': S, 'abundance': abundance, 'lengths': lengths, 'quals': Q}
+        derep['remap' + name] = remap
+    keys = list(pairs.keys())
+    derep['pairs'] = np.array([[derep['remapF'][i] + 1, derep['remapR'][j] + 1, pairs[(i, j)]] for i, j in keys],
+                              dtype=np.int32).reshape(-1, 3)
+    del derep['remapF'], derep['remapR']
+    return derep
+
+
+def write_derep(fn, derep):
+    """Write a dereplicated sample as gzipped binary index (see module doc).
+    """
+    i4 = lambda x: np.asarray(x, dtype='<i4').tobytes()
+    with gzip.open(fn + '.tmp', 'wb', compresslevel=4) as fh:
+        fh.write(i4([derep['input'], derep['filtered']]))
+        for name in ['F', 'R']:
+            d = derep[name]
+            fh.write(i4(d['seqs'].shape))
+            fh.write(i4(d['abundance']) + i4(d['lengths']))
+            fh.write(np.ascontiguousarray(d['seqs'], dtype=np.uint8).tobytes())
+            fh.write(np.ascontiguousarray(d['quals'], dtype='<f4').tobytes())
+        P = derep['pairs']
+        fh.write(i4([len(P)]) + i4(P[:, 0]) + i4(P[:, 1]) + i4(P[:, 2]))
+    os.replace(fn + '.tmp', fn)
+
+
+def read_derep(fn):
+    """Read a dereplicated sample written by `write_derep`.
+    """
+    with gzip.open(fn, 'rb') as fh:
+        buf = fh.read()
+    pos = [0]
+
+    def take(dtype, count):
+        a = np.frombuffer(buf, dtype=dtype, count=count, offset=pos[0])
+        pos[0] += a.nbytes
+        return a
+    n_input, filtered = take('<i4', 2)
+    derep = {'input': int(n_input), 'filtered': int(filtered)}
+    for name in ['F', 'R']:
+        n, width = take('<i4', 2)
+        d = {'abundance': take('<i4', n), 'lengths': take('<i4', n)}
+        d['seqs'] = take(np.uint8, n * width).reshape(n, width)
+        d['quals'] = take('<f4', n * width).reshape(n, width)
+        derep[name] = d
+    n = take('<i4', 1)[0]
+    derep['pairs'] = np.stack([take('<i4', n) for i in range(3)], axis=1)
+    return derep
+
+
+def dereplicate_worker(r1_fn, outdir, params):
+    sample = re.sub('_S[0-9]+_L[0-9]+_R1_001.fastq.gz$', '', os.path.basename(r1_fn))
+    derep = dereplicate_pairs(r1_fn, r1_fn.replace('_R1_001.fastq.gz', '_R2_001.fastq.gz'), **params)
+    fn = os.path.join(outdir, sample + SUFFIX)
+    write_derep(fn, derep)
+    return sample, derep['input'], derep['filtered'], len(derep['pairs'])
+
+
+def dereplicate_dir(fastq_dir, outdir, threads=1, **params):
+    """Dereplicate all samples of a directory of `<sample>_S0_L001_R{1,2}_001.fastq.gz` files (qiime2 layout).
+
+    Samples are spread across a process pool. Returns a list of (sample, input reads, passed filter, unique pairs).
+    """
+    os.makedirs(outdir, exist_ok=True)
+    files = sorted(glob.glob(os.path.join(fastq_dir, '*_R1_001.fastq.gz')))
+    with mp.Pool(max(1, min(threads, len(files)))) as pool:
+        return pool.starmap(dereplicate_worker, [(fn, outdir, params) for fn in files])
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='directory of per sample fastq.gz files (qiime2 layout)')
+    parser.add_argument('--trim-left', help='forward,reverse bases trimmed from the start of reads', default='0,0')
+    parser.add_argument('--trunc-len', help='forward,reverse truncation length (0 to disable)', default='0,0')
+    parser.add_argument('--max-ee', help='forward,reverse maximum expected errors', default='inf,inf')
+    parser.add_argument('--trunc-q', help='truncate reads at the first quality score <= trunc-q', type=int, default=2)
+    parser.add_argument('--min-len', help='minimum read length after trimming', type=int, default=20)
+    parser.add_argument('--threads', help='number of processes', type=int, default=1)
+    parser.add_argument('--output-dir', help='output directory', required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    params = dict(trim_left=[int(i) for i in args.trim_left.split(',')],
+                  trunc_len=[int(i) for i in args.trunc_len.split(',')],
+                  max_ee=[float(i) for i in args.max_ee.split(',')], trunc_q=args.trunc_q, min_len=args.min_len)
+    for row in dereplicate_dir(args.input, args.output_dir, threads=args.threads, **params):
+        print('\t'.join(str(i) for i in row))
@@ -0,0 +1,108 @@
+"""Minimal streaming fastq reader/writer shared by the region split scripts.
+"""
+import io
+import gzip
+import shutil
+import subprocess
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+def open_fastq(fname, mode='rt'):
+    """Open a plain or gzipped fastq file.
+    """
+    if fname.endswith('.gz'):
+        return gzip.open(fname, mode)
+    return open(fname, mode)
+
+
+class PigzWriter(io.TextIOWrapper):
+    """Text stream compressed by a pigz subprocess.
+    """
+    def __init__(self, fname, level=1, threads=1):
+        self._out = open(fname, 'wb')
+        self._proc = subprocess.Popen(['pigz', '-c', '-{}'.format(level), '-p', str(threads)],
+                                      stdin=subprocess.PIPE, stdout=self._out, bufsize=1 << 20)
+        super().__init__(self._proc.stdin)
+
+    def close(self):
+        if self.closed:
+            return
+        super().close()
+        ret = self._proc.wait()
+        self._out.close()
+        if ret != 0:
+            raise subprocess.CalledProcessError(ret, 'pigz')
+
+
+def open_fastq_writer(fname, level=1, threads=1):
+    """Open a fastq file for writing, gzip compressed if `fname` ends with .gz.
+
+    Compression runs in a (multi-threaded) pigz process when available, with python gzip as fallback.
+    """
+    if fname.endswith('.gz'):
+        if shutil.which('pigz'):
+            return PigzWriter(fname, level=level, threads=threads)
+        return gzip.open(fname, 'wt', compresslevel=level)
+    return open(fname, 'w', buffering=1 << 20)
+
+
+class BlockGzipWriter(object):
+    """Binary gzip writer compressing blocks in a shared thread pool (zlib releases the GIL).
+
+    Every block is written as a separate gzip member, the output is a valid multi-member gzip file.
+    """
+    def __init__(self, fname, executor, level=1, max_pending=8):
+        self._out = open(fname, 'wb')
+        self._executor = executor
+        self._level = level
+        self._max_pending = max_pending
+        self._pending = collections.deque()
+
+    def write(self, data):
+        self._pending.append(self._executor.submit(gzip.compress, data, self._level))
+        while len(self._pending) > self._max_pending:
+            self._out.write(self._pending.popleft().result())
+
+    def close(self):
+        while self._pending:
+            self._out.write(self._pending.popleft().result())
+        self._out.close()
+
+
+def queue_writer(queue, level=1, threads=1):
+    """Write (file name, bytes) blocks received on `queue` to gzip files until None is received.
+
+    A (file name, None) message closes the file. One writer serves any number of files, with
+    `threads` compression threads shared between them.
+    """
+    files = {}
+    with ThreadPoolExecutor(max(1, threads)) as executor:
+        for fname, data in iter(queue.get, None):
+            if data is None:
+                files.pop(fname).close()
+                continue
+            if fname not in files:
+                files[fname] = BlockGzipWriter(fname, executor, level=level, max_pending=2 * max(1, threads))
+            files[fname].write(data)
+        for fh in files.values():
+            fh.close()
+
+
+def read_fastq(fh):
+    """Yield fastq records as (header, seq, plus, qual) tuples, newlines stripped.
+    """
+    while True:
+        header = fh.readline()
+        if not header:
+            break
+        seq = fh.readline()
+        plus = fh.readline()
+        qual = fh.readline()
+        if not qual:
+            raise ValueError('truncated fastq record: {}'.format(header.rstrip()))
+        yield header.rstrip('\n'), seq.rstrip('\n'), plus.rstrip('\n'), qual.rstrip('\n')
+
+
+def format_fastq(header, seq, plus, qual):
+    return '{}\n{}\n{}\n{}\n'.format(header, seq, plus, qual)
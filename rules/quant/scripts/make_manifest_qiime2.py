@@ -1,58 +1,53 @@
 #! /usr/bin/env python
+"""Create qiime2 manifest files of all regions from the per sample indexes written by region_demultiplex.py.
 
-
-import sys
-import yaml
+Index files are read once, line by line, and one manifest `<outdir>/<region>.tsv` is written per region with reads.
+A summary of regions (samples, read pairs, bytes) is written to `<outdir>/regions.tsv`.
+"""
 import os
 import argparse
-import re
-import warnings
-import glob
+import collections
 
 
-parser = argparse.ArgumentParser(description='create a valid qiime2 manifest file', formatter_class=argparse.RawDescriptionHelpFormatter)
-parser.add_argument('input', help='directories containing fastq files formatted as Sample_ID_[region]_R1[2].fastq[.gz]', nargs='+')
-parser.add_argument('--region', default='universal')
+parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+parser.add_argument('input', help='index files of region_demultiplex.py (sample-id, region, R1, R2, reads, bytes)', nargs='+')
+parser.add_argument('--region', help='comma separated list of regions, default is all regions')
+parser.add_argument('--min-count', help='minimum number of read pairs of a sample region', type=int, default=1)
 parser.add_argument('--outdir', default='.')
 
 
-def manifest_header(input_files, SAMPLES):
-    n_fastq, n_samples = len(input_files), len(SAMPLES)
-    if 2 * n_samples == n_fastq: #paired end
-        header = ['sample-id', 'forward-absolute-filepath', 'reverse-absolute-filepath']
-    elif n_samples == n_fastq: # single end
-        header = ['sample-id', 'forward-absolute-filepath']
-    else:
-        raise ValueError('fastq files contains non-unique sample-ids or is a mix of paired and single end reads!')
-
-    sys.stdout.write('\t'.join(header)  )
-
-
-        
+def read_indexes(index_files, regions=None, min_count=1):
+    """Collect manifest rows per region from index files.
+    """
+    manifests = collections.OrderedDict()
+    for fn in index_files:
+        with open(fn) as fh:
+            header = next(fh).rstrip('\n').split('\t')
+            for line in fh:
+                row = dict(zip(header, line.rstrip('\n').split('\t')))
+                region = row['region']
+                if region == 'unknown' or (regions and region not in regions):
+                    continue
+                if int(row['reads']) < min_count:
+                    continue
+                manifests.setdefault(region, []).append(row)
+    return manifests
 
 
 if __name__ == '__main__':
     args = parser.parse_args()
-    region = args.region or 'universal'
-    out_fn = os.path.join(args.outdir, '{}.tsv'.format(args.region))
-    rows = {}
-    for dir_name in args.input:
-        sample_id = os.path.split(dir_name)[-1]
-        if region == 'universal':
-            R1 = glob.glob(os.path.join(dir_name, '{}_*_R1.fastq'.format(sample_id)))
-            R2 = glob.glob(os.path.join(dir_name, '{}_*_R1.fastq'.format(sample_id)))
-        else:
-            R1 = os.path.join(dir_name, '{}_{}_R1.fastq'.format(sample_id, region)))
-            R2 = os.path.join(dir_name, '{}_{}_R2.fastq'.format(sample_id, region)))
-        if os.path.exists(R1) and os.path.exists(R2):
-            rows[sample_id] = [R1, R2]
+    regions = args.region.split(',') if args.region else None
+    manifests = read_indexes(args.input, regions=regions, min_count=args.min_count)
 
+    os.makedirs(args.outdir, exist_ok=True)
     header = ['sample-id', 'forward-absolute-filepath', 'reverse-absolute-filepath']
-    with open(out_fn) as fh:
-        fh.write('\t'.join(header) + '\n')
-        for sample, (R1, R2) in rows.items():
-            fh.write('\t'.join([sample_id, R1, R2]) + '\n')
-            
-
-                     
-    
+    with open(os.path.join(args.outdir, 'regions.tsv'), 'w') as summary:
+        summary.write('\t'.join(['region', 'samples', 'reads', 'bytes']) + '\n')
+        for region, rows in manifests.items():
+            with open(os.path.join(args.outdir, '{}.tsv'.format(region)), 'w') as fh:
+                fh.write('\t'.join(header) + '\n')
+                for row in rows:
+                    fh.write('\t'.join([row['sample-id'], os.path.abspath(row['R1']), os.path.abspath(row['R2'])]) + '\n')
+            reads = sum(int(row['reads']) for row in rows)
+            size = sum(int(row['bytes']) for row in rows)
+            summary.write('\t'.join([region, str(len(rows)), str(reads), str(size)]) + '\n')
@@ -0,0 +1,160 @@
+"""Per-stage timing, memory and I/O instrumentation.
+
+Cpu time is taken from getrusage of the process and its (terminated) children. Peak memory is the per step
+maximum of the summed memory (PSS) of the process and all its descendants, sampled in a background thread,
+and the high-water mark of the process itself (reset at the start of each step). Bytes read/written are the
+rchar/wchar counters of /proc/self/io, which include page cache and network file system I/O and reaped children.
+Without /proc (non linux), the lifetime maxrss and block I/O counters of getrusage are used.
+"""
+import os
+import time
+import json
+import resource
+import threading
+import collections
+from contextlib import contextmanager
+
+PROFILE = []
+
+COLUMNS = ['step', 'region', 'threads', 'start', 'wall_time', 'cpu_time', 'peak_rss_mb', 'read_bytes', 'write_bytes']
+
+HAS_PROC = os.path.exists('/proc/self/io')
+
+_ACTIVE = []
+
+
+def _read_proc(fn):
+    try:
+        with open(fn) as fh:
+            return fh.read()
+    except OSError:
+        return None
+
+
+def _proc_field(text, name):
+    for line in (text or '').splitlines():
+        if line.startswith(name + ':'):
+            return int(line.split()[1])
+    return 0
+
+
+def _descendants(pid):
+    children = collections.defaultdict(list)
+    for name in os.listdir('/proc'):
+        if name.isdigit():
+            stat = _read_proc('/proc/{}/stat'.format(name))
+            if stat:
+                children[int(stat.rsplit(')', 1)[1].split()[1])].append(int(name))
+    out, todo = [], [pid]
+    while todo:
+        pids = children[todo.pop()]
+        out.extend(pids)
+        todo.extend(pids)
+    return out
+
+
+def _tree_memory_mb(pid):
+    """Summed PSS (or RSS if not available) of a process and its descendants.
+    """
+    total = 0
+    for p in [pid] + _descendants(pid):
+        rollup = _read_proc('/proc/{}/smaps_rollup'.format(p))
+        total += _proc_field(rollup, 'Pss') if rollup else _proc_field(_read_proc('/proc/{}/status'.format(p)), 'VmRSS')
+    return total / 1024.0
+
+
+def _reset_hwm():
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        pass
+
+
+class _MemorySampler(threading.Thread):
+    """Sample the memory of the process tree until stopped, keeping the maximum.
+    """
+    def __init__(self, interval=0.5):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.peak = 0.0
+        self._stop_event = threading.Event()
+
+    def run(self):
+        pid = os.getpid()
+        while True:
+            self.peak = max(self.peak, _tree_memory_mb(pid))
+            if self._stop_event.wait(self.interval):
+                break
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+        return self.peak
+
+
+def _usage():
+    self = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    usage = {'cpu_time': self.ru_utime + self.ru_stime + children.ru_utime + children.ru_stime}
+    if HAS_PROC:
+        io = _read_proc('/proc/self/io')
+        usage['read_bytes'] = _proc_field(io, 'rchar')
+        usage['write_bytes'] = _proc_field(io, 'wchar')
+    else:
+        # block counts are in units of 512 bytes
+        usage['read_bytes'] = (self.ru_inblock + children.ru_inblock) * 512
+        usage['write_bytes'] = (self.ru_oublock + children.ru_oublock) * 512
+        # ru_maxrss is in kilobytes on linux
+        usage['peak_rss_mb'] = max(self.ru_maxrss, children.ru_maxrss) / 1024.0
+    return usage
+
+
+@contextmanager
+def profile(step, region=None, threads=1):
+    """Record wall time, cpu time, peak memory and bytes read/written of a pipeline step.
+
+    The yielded record is filled in when the step completes and appended to `PROFILE`. The peak of a
+    nested step is included in the peaks of the enclosing steps.
+    """
+    record = {'step': step, 'region': region, 'threads': threads, 'start': time.strftime('%Y-%m-%d %X')}
+    sampler = None
+    if HAS_PROC:
+        _reset_hwm()
+        sampler = _MemorySampler()
+        sampler.start()
+    _ACTIVE.append(record)
+    t0 = time.time()
+    u0 = _usage()
+    try:
+        yield record
+    finally:
+        u1 = _usage()
+        _ACTIVE.pop()
+        if sampler is not None:
+            hwm = _proc_field(_read_proc('/proc/self/status'), 'VmHWM') / 1024.0
+            peak = max(sampler.stop(), hwm, record.get('peak_rss_mb', 0.0))
+        else:
+            peak = u1['peak_rss_mb']
+        for outer in _ACTIVE:
+            outer['peak_rss_mb'] = max(outer.get('peak_rss_mb', 0.0), peak)
+        record['wall_time'] = round(time.time() - t0, 3)
+        record['cpu_time'] = round(u1['cpu_time'] - u0['cpu_time'], 3)
+        record['peak_rss_mb'] = round(peak, 1)
+        record['read_bytes'] = u1['read_bytes'] - u0['read_bytes']
+        record['write_bytes'] = u1['write_bytes'] - u0['write_bytes']
+        PROFILE.append(record)
+
+
+def write_profile(output_dir, name='profile'):
+    """Write recorded steps to `<output_dir>/<name>.json` and `<output_dir>/<name>.tsv`.
+    """
+    if not PROFILE:
+        return
+    os.makedirs(output_dir, exist_ok=True)
+    with open(os.path.join(output_dir, name + '.json'), 'w') as fh:
+        json.dump(PROFILE, fh, indent=2)
+    with open(os.path.join(output_dir, name + '.tsv'), 'w') as fh:
+        fh.write('\t'.join(COLUMNS) + '\n')
+        for record in PROFILE:
+            fh.write('\t'.join('' if record.get(k) is None else str(record[k]) for k in COLUMNS) + '\n')
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Summary visualizations of run_qiime2.py output created off the critical path (run_qiime2.py --skip-summaries).
+
+One job per region and one for the merged table, which Snakemake runs in parallel.
+"""
+import os
+from os.path import join
+import argparse
+
+from qiime2 import Artifact, Metadata
+
+from run_qiime2 import dada2_summary, taxonomy_summary, summary_data
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output-dir", help="run_qiime2.py output directory", required=True)
+    parser.add_argument("--sample-info", help="sample metadata", required=True)
+    parser.add_argument("--region", help="summarize a single region, default is the merged table")
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    samples = Metadata.load(os.path.abspath(args.sample_info))
+    if args.region:
+        outdir = join(args.output_dir, 'regions', args.region)
+        data = {name: {args.region: Artifact.load(join(outdir, name + '.qza'))}
+                for name in ['table', 'sequence', 'stats', 'taxonomy']}
+        summary = dada2_summary(data['table'], data['sequence'], data['stats'])[args.region]
+        summary.update(taxonomy_summary(data['taxonomy'], data['table'], samples)[args.region])
+    else:
+        outdir = args.output_dir
+        table, taxonomy, sequence = [Artifact.load(join(outdir, name + '.qza')) for name in ['table', 'taxonomy', 'sequence']]
+        summary = summary_data(table, taxonomy, sequence, samples)
+
+    for name, viz in summary.items():
+        if hasattr(viz, 'visualization'):
+            viz = viz.visualization
+        viz.save(join(outdir, name))
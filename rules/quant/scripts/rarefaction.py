@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+"""Alpha rarefaction of a feature table (observed features, shannon and faith pd).
+
+Subsamples are nested: for every sample and iteration one random draw of max-depth reads (without replacement)
+is taken, and the subsample at each depth is a prefix of this draw. All metrics and depths are computed in the
+same pass, and samples are spread across a process pool.
+
+Output is one csv file per metric in the layout of the qiime2 alpha-rarefaction visualization
+(sample-id, depth-<d>_iter-<i> columns, metadata columns).
+"""
+import os
+import argparse
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+METRICS = ['observed_otus', 'shannon', 'faith_pd']
+
+
+def rarefaction_depths(max_depth, min_depth=1, steps=10):
+    """Evenly spaced depths between `min_depth` and `max_depth` (as qiime2 alpha-rarefaction).
+    """
+    return sorted(set(int(d) for d in np.linspace(min_depth, max_depth, num=steps)))
+
+
+def tree_incidence(tree, feature_ids):
+    """Sparse features x branches matrix of the branches between each feature tip and the root.
+
+    Returns the matrix and the branch lengths. The root branch is not included (as skbio faith_pd).
+    """
+    nodes = [n for n in tree.preorder() if not n.is_root()]
+    index = {id(n): i for i, n in enumerate(nodes)}
+    lengths = np.array([n.length or 0.0 for n in nodes])
+    tips = {t.name: t for t in tree.tips()}
+    rows, cols = [], []
+    for i, fid in enumerate(feature_ids):
+        node = tips.get(fid)
+        if node is None:
+            raise ValueError('feature {} is not in the tree'.format(fid))
+        while not node.is_root():
+            rows.append(i)
+            cols.append(index[id(node)])
+            node = node.parent
+    A = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(feature_ids), len(nodes)))
+    return A, lengths
+
+
+def rarefy(X, depth, seed=0):
+    """Subsample each row of a sparse samples x features count matrix to `depth` reads without replacement.
+
+    Rows with fewer reads than `depth` are dropped. Returns the rarefied csr matrix and the kept row indices.
+    """
+    X = sparse.csr_matrix(X)
+    keep = np.flatnonzero(np.asarray(X.sum(axis=1)).ravel() >= depth)
+    rng = np.random.default_rng(seed)
+    rows, cols, vals = [], [], []
+    for k, i in enumerate(keep):
+        row = X.getrow(i)
+        bounds = np.cumsum(row.data.astype(int))
+        draw = np.searchsorted(bounds, rng.choice(bounds[-1], depth, replace=False), side='right')
+        counts = np.bincount(draw, minlength=len(row.indices))
+        nz = counts > 0
+        rows.append(np.full(nz.sum(), k))
+        cols.append(row.indices[nz])
+        vals.append(counts[nz])
+    if len(keep) == 0:
+        return sparse.csr_matrix((0, X.shape[1])), keep
+    R = sparse.csr_matrix((np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(keep), X.shape[1]))
+    return R, keep
+
+
+def alpha_metrics(counts, metrics, incidence=None, lengths=None):
+    """Metrics of a depths x features count matrix. Returns a metrics x depths array.
+    """
+    out = np.empty((len(metrics), counts.shape[0]))
+    observed = counts > 0
+    for i, metric in enumerate(metrics):
+        if metric == 'observed_otus':
+            out[i] = observed.sum(axis=1)
+        elif metric == 'shannon':
+            p = counts / counts.sum(axis=1, keepdims=True)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                out[i] = 0.0 - np.where(observed, p * np.log2(p), 0).sum(axis=1)
+        elif metric == 'faith_pd':
+            covered = sparse.csr_matrix(observed).dot(incidence).toarray() > 0
+            out[i] = covered.dot(lengths)
+        else:
+            raise ValueError('metric {} is not supported!'.format(metric))
+    return out
+
+
+_RAREFACTION_DATA = {}
+
+def rarefy_sample(i):
+    """Nested rarefaction of sample `i` over all depths and iterations.
+
+    Input is read from the module level `_RAREFACTION_DATA` which is shared with forked workers.
+    Returns a metrics x depths x iterations array, NaN for depths above the sample total.
+    """
+    d = _RAREFACTION_DATA
+    row = d['X'].getrow(i)
+    features, counts = row.indices, row.data.astype(int)
+    depths, metrics = d['depths'], d['metrics']
+    res = np.full((len(metrics), len(depths), d['iterations']), np.nan)
+    total = counts.sum()
+    valid = [k for k, depth in enumerate(depths) if depth <= total]
+    if not valid:
+        return res
+    max_depth = depths[valid[-1]]
+    bounds = np.cumsum(counts)
+    incidence = d['incidence'][features] if d['incidence'] is not None else None
+    rng = np.random.default_rng([d['seed'], i])
+    for it in range(d['iterations']):
+        # random order of max_depth reads, every prefix is a subsample without replacement
+        draw = np.searchsorted(bounds, rng.choice(total, max_depth, replace=False), side='right')
+        C = np.zeros((len(valid), len(features)))
+        c = np.zeros(len(features))
+        prev = 0
+        for j, k in enumerate(valid):
+            c += np.bincount(draw[prev:depths[k]], minlength=len(features))
+            C[j] = c
+            prev = depths[k]
+        res[:, valid, it] = alpha_metrics(C, metrics, incidence, d['lengths'])
+    return res
+
+
+def alpha_rarefaction(table, depths, iterations=10, metrics=('observed_otus', 'shannon'), tree=None, threads=1, seed=0):
+    """Alpha rarefaction of a biom table. Returns a dict of sample x depth-<d>_iter-<i> dataframes per metric.
+    """
+    metrics = list(metrics)
+    for m in metrics:
+        if m not in METRICS:
+            raise ValueError('metric {} is not supported!'.format(m))
+    incidence, lengths = None, None
+    if 'faith_pd' in metrics:
+        if tree is None:
+            raise ValueError('faith_pd requires a phylogenetic tree')
+        incidence, lengths = tree_incidence(tree, list(table.ids('observation')))
+    X = table.matrix_data.T.tocsr()
+    _RAREFACTION_DATA.update(X=X, depths=list(depths), iterations=iterations, metrics=metrics, incidence=incidence,
+                             lengths=lengths, seed=seed)
+    with mp.Pool(max(1, threads)) as pool:
+        res = pool.map(rarefy_sample, range(X.shape[0]), chunksize=max(1, X.shape[0] // (4 * max(1, threads))))
+    _RAREFACTION_DATA.clear()
+    res = np.stack(res)
+    columns = ['depth-{}_iter-{}'.format(depth, it + 1) for depth in depths for it in range(iterations)]
+    index = pd.Index(table.ids('sample'), name='sample-id')
+    return {m: pd.DataFrame(res[:, i].reshape(len(index), -1), index=index, columns=columns)
+            for i, m in enumerate(metrics)}
+
+
+def write_rarefaction(results, outdir, metadata=None):
+    """Write one `<metric>.csv` per metric, with metadata columns appended as in qiime2 alpha-rarefaction.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    for metric, df in results.items():
+        if metadata is not None:
+            df = df.join(metadata, how='left')
+        df.to_csv(os.path.join(outdir, '{}.csv'.format(metric)))
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', help='FeatureTable[Frequency] artifact', required=True)
+    parser.add_argument('--phylogeny', help='Phylogeny[Rooted] artifact (required by faith_pd)')
+    parser.add_argument('--metadata', help='sample metadata')
+    parser.add_argument('--metrics', help='comma separated list of metrics', default='observed_otus,shannon,faith_pd')
+    parser.add_argument('--min-depth', help='minimum rarefaction depth', type=int, default=1)
+    parser.add_argument('--max-depth', help='maximum rarefaction depth', type=int, required=True)
+    parser.add_argument('--steps', help='number of depths', type=int, default=10)
+    parser.add_argument('--iterations', help='number of rarefied tables per depth', type=int, default=10)
+    parser.add_argument('--seed', help='random seed', type=int, default=0)
+    parser.add_argument('--threads', help='number of processes', type=int, default=1)
+    parser.add_argument('--output-dir', help='output directory', required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    import biom
+    import skbio
+    from qiime2 import Artifact, Metadata
+
+    args = get_parser().parse_args()
+    table = Artifact.load(args.table).view(biom.Table)
+    tree = Artifact.load(args.phylogeny).view(skbio.TreeNode) if args.phylogeny else None
+    metadata = Metadata.load(args.metadata).to_dataframe() if args.metadata else None
+    depths = rarefaction_depths(args.max_depth, args.min_depth, args.steps)
+    results = alpha_rarefaction(table, depths, iterations=args.iterations, metrics=args.metrics.split(','), tree=tree,
+                                threads=args.threads, seed=args.seed)
+    write_rarefaction(results, args.output_dir, metadata=metadata)
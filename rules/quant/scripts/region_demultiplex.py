@@ -1,38 +1,164 @@
 import os
 from os.path import join
-import subprocess
-import multiprocessing as mp
-import glob
 import argparse
+import itertools
+import collections
 
 import pandas as pd
 
-def cutadapt_worker(fname, sample, forward, reverse, log_fn=None):
-    for i, r in forward.iterrows():
-        if os.path.exists("{}_unknown_R1.fastq".format(sample)):
-            fname = "{}_unknown_R1.fastq".format(sample)
-            cp_cmd = "mv -f {} input_{}".format(fname, fname)
-            subprocess.check_call(cp_cmd, shell=True)
-            cp_cmd = "mv -f {} input_{}".format(fname.replace("R1.fastq","R2.fastq"), fname.replace("R1.fastq","R2.fastq"))
-            subprocess.check_call(cp_cmd, shell=True)
-
-        cmd = "cutadapt -g {region}={fwd_primer} -G {region}={rev_primer} --pair-adapters --no-indels -e 0.1 --untrimmed-output {unknown_r1} --untrimmed-paired-output {unknown_r2} --suffix ':region={{name}}' -o {sample}_{{name}}_R1.fastq -p {sample}_{{name}}_R2.fastq {r1} {r2} >> {log}"
-
-        cmd = cmd.format(sample = sample,
-                         unknown_r1 = "{}_unknown_R1.fastq".format(sample),
-                         unknown_r2 = "{}_unknown_R2.fastq".format(sample),
-                         region = i,
-                         fwd_primer = r['seq'],
-                         rev_primer = reverse.loc[i, 'seq'],
-                         r1 = ("input_" + fname) if "unknown_R1.fastq" in fname else fname,
-                         r2 = ("input_" + fname.replace("R1.fastq", "R2.fastq")) if "unknown_R1.fastq" in fname else fname.replace("R1.fastq", "R2.fastq"),
-                         log=log_fn
-        )
-        
-        subprocess.check_call(cmd, shell=True)
-
-    rm_cmd = "rm input_{}_*fastq".format(sample)
-    subprocess.check_call(rm_cmd, shell=True)
+from fastq_io import open_fastq, open_fastq_writer, read_fastq, format_fastq
+
+IUPAC = {
+    'A': 'A', 'C': 'C', 'G': 'G', 'T': 'T', 'U': 'T',
+    'R': 'AG', 'Y': 'CT', 'S': 'CG', 'W': 'AT', 'K': 'GT', 'M': 'AC',
+    'B': 'CGT', 'D': 'AGT', 'H': 'ACT', 'V': 'ACG', 'N': 'ACGT'
+}
+
+
+def primer_index(primers, error_rate=0.1, max_expand=64):
+    """Precompute a k-mer seed index over all primers.
+
+    Seed length is chosen so that every primer with at most `floor(error_rate * len)` mismatches
+    contains at least one exact seed (pigeonhole). Degenerate (IUPAC) positions are expanded,
+    windows with more than `max_expand` expansions are not indexed. Primers where this breaks the
+    pigeonhole guarantee are matched by a direct scan instead.
+
+    Returns the seed length, a dict kmer -> [(region, primer offset)] and a dict
+    region -> (allowed bases per position, max errors, direct scan).
+    """
+    patterns = {}
+    for region, seq in primers.items():
+        seq = seq.upper()
+        allowed = [set(IUPAC[b]) for b in seq]
+        patterns[region] = (allowed, int(error_rate * len(seq)))
+    k = min(max(4, len(p) // (e + 1)) for p, e in patterns.values())
+    index = collections.defaultdict(list)
+    for region, (allowed, e) in list(patterns.items()):
+        skipped = set()
+        for offset in range(len(allowed) - k + 1):
+            window = allowed[offset:offset + k]
+            n = 1
+            for a in window:
+                n *= len(a)
+            if n > max_expand:
+                skipped.add(offset)
+                continue
+            for kmer in itertools.product(*window):
+                index[''.join(kmer)].append((region, offset))
+        # the e + 1 disjoint windows at offsets 0, k, .., e * k must all be seeds
+        scan = any(i * k in skipped for i in range(e + 1))
+        patterns[region] = (allowed, e, scan)
+    return k, dict(index), patterns
+
+
+def mismatches(seq, start, allowed, max_err):
+    n = 0
+    for i, a in enumerate(allowed):
+        if seq[start + i] not in a:
+            n += 1
+            if n > max_err:
+                break
+    return n
+
+
+def match_primers(seq, k, index, patterns, max_offset=50):
+    """Find the best matching primer in the 5' end of a read.
+
+    Returns a dict region -> trim position (end of primer) for all regions matching with their
+    lowest number of mismatches. Primers may start anywhere within the first `max_offset` bases.
+    """
+    hits = {}
+
+    def add_hit(region, start):
+        allowed, max_err, scan = patterns[region]
+        end = start + len(allowed)
+        if start < 0 or start > max_offset or end > len(seq):
+            return
+        n = mismatches(seq, start, allowed, max_err)
+        if n <= max_err and (region not in hits or (n, start) < hits[region][:2]):
+            hits[region] = (n, start, end)
+
+    # seeds of a primer starting at max_offset may lie up to the end of the primer
+    max_len = max(len(allowed) for allowed, max_err, scan in patterns.values())
+    last = min(len(seq), max_offset + max_len) - k + 1
+    for pos in range(max(last, 0)):
+        for region, offset in index.get(seq[pos:pos + k], ()):
+            add_hit(region, pos - offset)
+    for region, (allowed, max_err, scan) in patterns.items():
+        if scan:
+            for start in range(max_offset + 1):
+                add_hit(region, start)
+    return {region: end for region, (n, start, end) in hits.items()}
+
+
+def primer_demultiplex(R1, R2, sample, forward, reverse, outdir='.', error_rate=0.1, max_offset=50, compress=0, log_fn=None):
+    """Split paired fastq files into regions by matching 5 prime ends with conserved region primer sequences.
+
+    All forward/reverse primer pairs are matched in a single pass over the input. A read pair is
+    assigned to the first region (in primer table order) where the forward primer matches R1 and
+    the paired reverse primer matches R2 (cutadapt `--pair-adapters --no-indels -e` semantics).
+    Primers are trimmed and `:region=<name>` is appended to the headers. Unassigned pairs are
+    written untrimmed to `<sample>_unknown_R[12].fastq`. Output is gzipped (`.fastq.gz`) at level `compress` if set.
+    """
+    regions = list(forward.index)
+    fwd_k, fwd_index, fwd_patterns = primer_index(forward['seq'].to_dict(), error_rate)
+    rev_k, rev_index, rev_patterns = primer_index(reverse.loc[regions, 'seq'].to_dict(), error_rate)
+
+    ext = '.fastq.gz' if compress else '.fastq'
+    handles = {}
+    for name in regions + ['unknown']:
+        handles[name] = (open_fastq_writer(join(outdir, '{}_{}_R1{}'.format(sample, name, ext)), level=compress or 1),
+                         open_fastq_writer(join(outdir, '{}_{}_R2{}'.format(sample, name, ext)), level=compress or 1))
+    counts = collections.OrderedDict((name, 0) for name in regions + ['unknown'])
+    try:
+        with open_fastq(R1) as fh1, open_fastq(R2) as fh2:
+            for rec1, rec2 in zip(read_fastq(fh1), read_fastq(fh2)):
+                fwd_hits = match_primers(rec1[1], fwd_k, fwd_index, fwd_patterns, max_offset)
+                region = None
+                if fwd_hits:
+                    rev_hits = match_primers(rec2[1], rev_k, rev_index, rev_patterns, max_offset)
+                    for r in regions:
+                        if r in fwd_hits and r in rev_hits:
+                            region = r
+                            break
+                if region is None:
+                    out1, out2 = handles['unknown']
+                    out1.write(format_fastq(*rec1))
+                    out2.write(format_fastq(*rec2))
+                    counts['unknown'] += 1
+                    continue
+                suffix = ':region={}'.format(region)
+                t1, t2 = fwd_hits[region], rev_hits[region]
+                out1, out2 = handles[region]
+                out1.write(format_fastq(rec1[0] + suffix, rec1[1][t1:], rec1[2], rec1[3][t1:]))
+                out2.write(format_fastq(rec2[0] + suffix, rec2[1][t2:], rec2[2], rec2[3][t2:]))
+                counts[region] += 1
+    finally:
+        for out1, out2 in handles.values():
+            out1.close()
+            out2.close()
+
+    if log_fn is not None:
+        with open(log_fn, 'a') as fh:
+            fh.write('sample: {}\n'.format(sample))
+            fh.write('total read pairs: {}\n'.format(sum(counts.values())))
+            for name, n in counts.items():
+                fh.write('{}\t{}\n'.format(name, n))
+    return counts
+
+
+def write_index(index_fn, sample, counts, outdir='.', compress=False):
+    """Write a per sample index of the demultiplexed files (region, R1, R2, read pairs, bytes).
+
+    The index lets downstream steps build manifests without listing the output directories.
+    """
+    ext = '.fastq.gz' if compress else '.fastq'
+    with open(index_fn, 'w') as fh:
+        fh.write('\t'.join(['sample-id', 'region', 'R1', 'R2', 'reads', 'bytes']) + '\n')
+        for region, n in counts.items():
+            R1, R2 = [join(outdir, '{}_{}_{}{}'.format(sample, region, read, ext)) for read in ['R1', 'R2']]
+            size = os.path.getsize(R1) + os.path.getsize(R2)
+            fh.write('\t'.join([sample, region, R1, R2, str(n), str(size)]) + '\n')
 
 
 def get_parser():
@@ -43,11 +169,16 @@ def get_parser():
     parser.add_argument('--fwd-primers', help='csv file with forward primers per region')
     parser.add_argument('--rev-primers', help='csv file with revers primers per region')
     parser.add_argument('--sample-id', help='sample ID')
+    parser.add_argument('--error-rate', help='maximum allowed mismatch rate in primer match', type=float, default=0.1)
+    parser.add_argument('--max-offset', help='maximum primer start position in read', type=int, default=50)
+    parser.add_argument('--compress', help='gzip compressed output, with optional compression level (default: 1)', type=int,
+                        nargs='?', const=1, default=0)
     parser.add_argument('--log', help='log file')
     parser.add_argument('--output', help='output directory')
+    parser.add_argument('--index', help='output index of demultiplexed files (default: <output>.index.tsv)')
     return parser
-                        
-                        
+
+
 
 if __name__ == '__main__':
     parser = get_parser()
@@ -57,16 +188,15 @@ if __name__ == '__main__':
     rev = pd.read_csv(args.rev_primers, index_col=0, sep='\t')
 
     args.R1 = os.path.abspath(args.R1)
+    if args.R2 is None:
+        args.R2 = args.R1.replace('_R1.fastq', '_R2.fastq')
+    args.R2 = os.path.abspath(args.R2)
     args.output = os.path.abspath(args.output)
     args.log = os.path.abspath(args.log)
-    call_dir = os.getcwd()
     if not os.path.exists(args.output):
         os.makedirs(args.output, exist_ok=True)
-    os.chdir(args.output)
-    cutadapt_worker(args.R1, args.sample_id, fwd, rev, log_fn=args.log)
-    os.chdir(call_dir)
-    
-    
-
-    
-    
+    counts = primer_demultiplex(args.R1, args.R2, args.sample_id, fwd, rev, outdir=args.output,
+                                error_rate=args.error_rate, max_offset=args.max_offset, compress=args.compress,
+                                log_fn=args.log)
+    write_index(args.index or args.output + '.index.tsv', args.sample_id, counts, outdir=args.output,
+                compress=args.compress)
@@ -14,19 +14,31 @@ import glob
 import itertools
 import collections
 import time
+import hashlib
+import functools
+import json
+import atexit
 
 import yaml
 from yaml import CLoader as Loader
 
 import qiime2
 from qiime2 import Artifact, Metadata
-from qiime2.plugins import metadata, feature_table, alignment, phylogeny, diversity, feature_classifier, taxa, dada2, demux
+from qiime2.plugins import metadata, feature_table, alignment, phylogeny, diversity, feature_classifier, taxa, dada2
 
 import pandas as pd
 
+from fastq_io import open_fastq, open_fastq_writer, read_fastq, format_fastq, queue_writer
+from taxa_filter import taxonomy_mask
+from profiling import profile, write_profile, PROFILE
+from rarefaction import alpha_rarefaction, rarefaction_depths, write_rarefaction
+
 __doc__ = "Analysis of microbiome fastq files with QIIME2"
 __version__ = '0.1'
 
+DADA2_SCRIPT = join(os.path.dirname(abspath(__file__)), 'dada2_paired.R')
+DEREPLICATE_SCRIPT = join(os.path.dirname(abspath(__file__)), 'dereplicate.py')
+
 def available_primers(libprep_conf):
     primers = {}
     with open(libprep_conf) as fh:
@@ -62,143 +74,171 @@ def get_parser():
     parser.add_argument("--taxonomy-db", help="reference database", choices=['silva', 'greengenes', 'unite'], required=True)
     parser.add_argument("--classifier-dir", help="path to prebuildt classifiers", required=True)
     parser.add_argument("--classifier-level", help="prebuilt classifier level to use", default='99')
+    parser.add_argument("--classifier-cache-dir", help="directory for memory mapped classifier cache (default: <classifier-dir>/cache)")
+    parser.add_argument("--taxonomy-cache", help="sqlite file with cached taxonomy assignments (default: <classifier-cache-dir>/taxonomy.sqlite). Use `None` to disable")
+    parser.add_argument("--classify-memory", help="memory budget (GB) of taxonomy classification, sequences are classified in batches sized to fit", type=float)
     parser.add_argument("--libprep-config", help="full path to gcfdb libprep.config", required=True)
     parser.add_argument("--filter-region-count", help="minimum number of reads within a region", type=int, default=500)
     parser.add_argument("--min-confidence", help="minimum accepted confidence for feature classifier", type=float, default=0.8)
     parser.add_argument("--build-tree", help="output phylogenetic tree", action="store_true")
+    parser.add_argument("--tree-reference-dir", help="project reference alignment and tree, new features are placed in the reference tree (default: <output-dir>/tree_reference)")
+    parser.add_argument("--rebuild-tree", help="build the reference tree de novo", action="store_true")
+    parser.add_argument("--skip-summaries", help="do not create summary visualizations (see qiime2_summary.py)", action="store_true")
     parser.add_argument("--threads", help="number of threads", type=int, default=1)
+    parser.add_argument("--compress-level", help="gzip level of the region split fastq files", type=int, default=1)
+    parser.add_argument("--shared-error-model", help="learn dada2 error models once per sequencing run and share them between regions", action="store_true")
+    parser.add_argument("--error-model-dir", help="cache directory of shared dada2 error models (default: <output-dir>/error_models)")
+    parser.add_argument("--pooling-method", help="dada2 pooling method of shared error model denoising (default: libprep config or independent)", choices=['independent', 'pseudo', 'pooled'])
+    parser.add_argument("--run-id", help="sequencing run id of shared error models (default: instrument/run/flowcell from fastq headers)")
+    parser.add_argument("--dereplicate", help="filter and dereplicate read pairs per sample before denoising, without phiX removal (implies --shared-error-model)", action="store_true")
+    parser.add_argument("--per-sample", help="denoise samples in parallel shards, pseudo pooled unless --pooling-method is given (implies --shared-error-model)", action="store_true")
+    parser.add_argument("--incremental", help="merge the samples of this run into the project data of earlier runs in <output-dir>/project", action="store_true")
+    parser.add_argument("--overlap-method", help="incremental merge of samples already in the project", choices=['error', 'sum', 'replace'], default='error')
+    parser.add_argument("--region-rarefaction", help="alpha rarefaction of each region table, written to <output-dir>/alpha_rarefaction/<region>", action="store_true")
+    parser.add_argument("--resume", help="skip stages with valid results in <output-dir>/stage_cache", action="store_true")
     return parser
 
 
-def cutadapt_worker(fname, regions, primers):
-    """Split fastq files into regions by matching 5 prime ends with conserved region primer sequences.
+_REGION_QUEUES = {}
 
-    This function requires cutadapt installed (tested with cutadapt 2.8)
-    """
-    sample = basename(fname).split('_R1.fastq')[0]
-    for region, seq in primers.items():
-        fwd, rev = seq.split('-')
-        if exists('{}_unknown_R1.fastq'.format(sample)):
-            fname = '{}_unknown_R1.fastq'.format(sample)
-            cp_cmd = 'mv -f {} input_{}'.format(fname, fname)
-            subprocess.check_call(cp_cmd, shell=True)
-            cp_cmd = 'mv -f {} input_{}'.format(fname.replace('R1.fastq', 'R2.fastq'), fname.replace('R1.fastq', 'R2.fastq'))
-            subprocess.check_call(cp_cmd, shell=True)
-            cmd = """cutadapt -g {region}={fwd_primer} -G {region}={rev_primer} --pair-adapters --no-indels -e 0.1 --untrimmed-output {unknown_r1} --untrimmed-paired-output {unknown_r2} --suffix ':region={{name}}' -o {sample}_{{name}}_R1.fastq -p {sample}_{{name}}_R2.fastq {r1} {r2} >> log/{sample}_region_demultiplex.log"""
-        cmd = cmd.format(
-            sample=sample,
-            unknown_r1='{}_unknown_R1.fastq'.format(sample),
-            unknown_r2='{}_unknown_R2.fastq'.format(sample),
-            region=seq,
-            fwd_primer=r['primer'],
-            rev_primer=reverse.loc[i, 'primer'],
-            r1=('input_' + fname) if 'unknown_R1.fastq' in fname else fname,
-            r2=('input_' + fname.replace('R1.fastq', 'R2.fastq'))
-            if 'unknown_R1.fastq' in fname
-            else fname.replace('R1.fastq', 'R2.fastq'),
-        )
-        subprocess.check_call(cmd, shell=True)
-
-    rm_cmd = 'rm input_{}_*fastq'.format(sample)
-    subprocess.check_call(rm_cmd, shell=True)
-
-
-def seqkit_worker(fname, region):
-    """split fastq files into regions by matching fastq header
-
-    Region header is identified by region=, e.g region=V1V2.
-    This function requires seqkit installed (tested with version 0.12)
+def header_router_worker(fname, regions, block_size=1 << 20):
+    """Split fastq files into regions by matching fastq header in a single pass.
+
+    Region header is identified by region=, e.g region=V1V2. Each R1/R2 file is read once and records are sent in
+    blocks to the shared gzip writer of their region and read (the module level `_REGION_QUEUES`, see `queue_writer`).
+    Records of regions not in `regions` are dropped. Files are written in the per sample directory layout of qiime2
+    (`<region>/<sample>_<region>_S0_L001_R1_001.fastq.gz`), so they can be imported as is.
 
+    Returns the sample name and a dict of read pair counts per region.
     """
     sample = basename(fname).split('_R1.fastq')[0]
-
-    cmd = 'seqkit grep -n -r -p region={} {} -o {}_{}_R1.fastq'.format(region, fname, sample, region)
-    subprocess.check_call(cmd, shell=True)
-    fname = fname.replace('_R1.fastq', '_R2.fastq')
-    cmd = 'seqkit grep -n -r -p region={} {} -o {}_{}_R2.fastq'.format(region, fname, sample, region)
-    subprocess.check_call(cmd, shell=True)
-    print(cmd)
-
-    # clean up empty files
-    # subprocess.check_call("""for file in *.fastq; do if [[ ! -s $file ]]; then rm $file; fi; done""", shell=True)
-
-
-def pandas_manifest(R1):
-    """Create a qiime2 manifest format pandas dataframe from a list of fwd fastq reads.
+    regions = set(regions)
+    counts = collections.Counter()
+    for read, fn in [('R1', fname), ('R2', fname.replace('_R1.fastq', '_R2.fastq'))]:
+        out_fns, buffers, sizes = {}, collections.defaultdict(list), collections.Counter()
+        with open_fastq(fn) as fh:
+            for header, seq, plus, qual in read_fastq(fh):
+                region = header.rsplit('region=', 1)[-1].split()[0].split(':')[0] if 'region=' in header else None
+                if region not in regions:
+                    continue
+                if region not in out_fns:
+                    os.makedirs(region, exist_ok=True)
+                    out_fns[region] = abspath(join(region, '{}_{}_S0_L001_{}_001.fastq.gz'.format(sample, region, read)))
+                rec = format_fastq(header, seq, plus, qual)
+                buffers[region].append(rec)
+                sizes[region] += len(rec)
+                if sizes[region] >= block_size:
+                    _REGION_QUEUES[(region, read)].put((out_fns[region], ''.join(buffers[region]).encode()))
+                    buffers[region], sizes[region] = [], 0
+                if read == 'R1':
+                    counts[region] += 1
+        for region, out_fn in out_fns.items():
+            if buffers[region]:
+                _REGION_QUEUES[(region, read)].put((out_fn, ''.join(buffers[region]).encode()))
+            _REGION_QUEUES[(region, read)].put((out_fn, None))
+    return sample, dict(counts)
+
+
+def import_region(region_dir, samples):
+    """Import a directory of demultiplexed per sample fastq.gz files without copying the reads.
+
+    The MANIFEST and metadata.yml of the qiime2 directory format are written next to the fastq files and the
+    directory is registered with `Artifact.import_data`, which hardlinks the files into the artifact.
     """
-    header = ['sample-id', 'forward-absolute-filepath', 'reverse-absolute-filepath']
-    rows = []
-    for fn in R1:
-        if os.stat(fn).st_size > 0:
-            sample_id = basename(fn).split('_R1.fastq')[0]
-            fn2 = fn.replace('_R1', '_R2')
-            assert exists(fn2)
-            rows.append([sample_id, fn, fn2])
-    if len(rows) > 0:
-        df = pd.DataFrame(rows, columns=header)
-        return df
-
-
-def import_data_worker(manifest_fn):
-    cmd = 'qiime tools import --type SampleData[PairedEndSequencesWithQuality] --input-path {} --input-format PairedEndFastqManifestPhred33V2 --output-path {}'
-    output_fn = manifest_fn.split('_')[0] + '.qza'
-    cmd = cmd.format(manifest_fn, output_fn)
-    print(cmd)
-    subprocess.check_call(cmd, shell=True)
-
-    #return Artifact.import_data('SampleData[PairedEndSequencesWithQuality]', manifest_fn,
-    #                            view_type='PairedEndFastqManifestPhred33V2')
-
-
-def demultiplex_manifests(fastq_files, primers, regions=None, split_on_header=True, threads=16):
-    """Demultiplex fastq files into variable region origins.
+    from q2_types.per_sample_sequences import SingleLanePerSamplePairedEndFastqDirFmt
+    with open(join(region_dir, 'MANIFEST'), 'w') as fh:
+        fh.write('sample-id,filename,direction\n')
+        for sample in samples:
+            for read, direction in [('R1', 'forward'), ('R2', 'reverse')]:
+                fh.write('{0},{0}_S0_L001_{1}_001.fastq.gz,{2}\n'.format(sample, read, direction))
+    with open(join(region_dir, 'metadata.yml'), 'w') as fh:
+        fh.write('{phred-offset: 33}\n')
+    return Artifact.import_data('SampleData[PairedEndSequencesWithQuality]', region_dir,
+                                view_type=SingleLanePerSamplePairedEndFastqDirFmt)
+
+
+def demultiplex_manifests(fastq_files, regions, min_count=0, threads=16, compress_level=1):
+    """Demultiplex fastq files into variable region origins by the `region=` header of reads (see region_demultiplex.py).
+
+    Samples are split in a process pool, and all samples of a region and read are compressed by one writer
+    process. The thread budget is split in half between the split workers and the writers (the writer half
+    is split across writers). Writers are watched while the samples are split, and a failed writer stops
+    the run instead of leaving the split workers blocked on a full queue. Regions with a total read count
+    not above `min_count` are not imported.
+    Returns a dict of imported artifacts per region and a sample x region table of read pair counts.
     """
-    if regions is not None:
-        primers  = {k:v for k, v in primers.items() if k in regions}
     r1 = [abspath(i) for i in fastq_files if '_R1.fastq' in i]
     rundir = mkdtemp() #run in a tmpdir
     cwd = os.path.abspath(os.curdir)
     os.chdir(rundir)
-    with mp.Pool(threads) as pool:
-        if split_on_header:
-            args_iter = itertools.product(r1, regions)
-            pool.starmap(seqkit_worker, args_iter)
-        else:
-            pool.map(cutadapt_worker, r1, primer_subset)
-
-    manifest_filenames = {}
-    for r in regions:
-        R1 = glob.glob(join(rundir, '*_{}_R1.fastq'.format(r)))
-        df = pandas_manifest(R1)
-        manifest_fn = r + '_manifest.csv'
-        if df is not None:
-            df.to_csv(manifest_fn, index=False, sep='\t')
-            manifest_filenames[r] = manifest_fn
+    keys = [(r, read) for r in regions for read in ['R1', 'R2']]
+    n_split = max(1, min(len(r1), threads // 2))
+    budget = thread_budget({k: 1 for k in keys}, max(len(keys), threads - n_split))
+    writers = {}
+    with profile('split_region', threads=threads):
+        for key, n in budget.items():
+            # puts are synchronous, blocks of a worker are in the pipe when its task returns
+            _REGION_QUEUES[key] = mp.SimpleQueue()
+            writers[key] = mp.Process(target=queue_writer, args=(_REGION_QUEUES[key], compress_level, n))
+            writers[key].start()
+        completed = False
+        try:
+            res = []
+            with mp.Pool(n_split) as pool:
+                it = pool.imap_unordered(functools.partial(header_router_worker, regions=regions), r1)
+                while len(res) < len(r1):
+                    try:
+                        res.append(it.next(timeout=1))
+                    except mp.TimeoutError:
+                        failed = [k for k, proc in writers.items() if proc.exitcode is not None]
+                        if failed:
+                            raise RuntimeError('fastq writer of {} {} failed with exit code {}'.format(
+                                failed[0][0], failed[0][1], writers[failed[0]].exitcode))
+            completed = True
+        finally:
+            # after a failure the queues may hold partial messages of terminated workers
+            for key, proc in writers.items():
+                if completed:
+                    _REGION_QUEUES[key].put(None)
+                else:
+                    proc.terminate()
+            for proc in writers.values():
+                proc.join()
+            _REGION_QUEUES.clear()
+        for key, proc in writers.items():
+            if proc.exitcode != 0:
+                raise RuntimeError('fastq writer of {} {} failed with exit code {}'.format(key[0], key[1], proc.exitcode))
+    order = {basename(fn).split('_R1.fastq')[0]: i for i, fn in enumerate(r1)}
+    res.sort(key=lambda x: order[x[0]])
+    read_counts = pd.DataFrame.from_dict(dict(res), orient='index')
+    read_counts = read_counts.reindex(index=[s for s, c in res], columns=regions).fillna(0).astype(int)
+    read_counts.index.name = 'sample-id'
 
     adata = {}
-    with mp.Pool(threads) as pool:
-        pool.map(import_data_worker, manifest_filenames.values())
-
-    for r, fn in manifest_filenames.items():
-        print('importing data ({}) from {}'.format(r, fn))
-        adata[r] = Artifact.load(fn.split('_')[0] + '.qza')
+    with profile('import'):
+        for r in regions:
+            if read_counts[r].sum() <= min_count:
+                continue
+            print('importing data ({})'.format(r))
+            samples = read_counts.index[read_counts[r] > 0] + '_' + r
+            adata[r] = import_region(join(rundir, r), samples)
 
     # clean up tmpdir
     os.chdir(cwd)
     shutil.rmtree(rundir)
-    return adata
+    return adata, read_counts
 
 
-def sequence_counts(adata, min_count=200000):
+def sequence_counts(read_counts, min_count=200000):
     """Summarize read count for each sample.
+
+    Uses the sample x region read count table collected during demultiplexing.
     """
     counts = {}
     merged_counts = collections.defaultdict(int)
-    for k, v in adata.items():
-        print('summarizing counts for region: {}'.format(k))
-        s = demux.visualizers.summarize(v)
-        fn = glob.glob(str(s.visualization._archiver.path) + '/*/data/per-sample-fastq-counts.csv')[0]
-        df = pd.read_csv(fn)
+    for k in read_counts.columns:
+        df = read_counts[k]
+        df = df[df > 0].rename('Sequence count').rename_axis('Sample name').reset_index()
         keep_region = df['Sequence count'].sum() > min_count
         if keep_region:
             counts[k] = df
@@ -209,47 +249,549 @@ def sequence_counts(adata, min_count=200000):
     return counts, merged_counts
 
 
-def denoise_dada2(adata, trunc_len_f=0, trunc_len_r=0, trim_left_f=0, trim_left_r=0, max_ee_f=6.0, max_ee_r=6.0, trunc_q=2,
-                  min_fold_parent_over_abundance=1.0, threads=4, pooling_method='pseudo'):
+def thread_budget(weights, threads):
+    """Split a thread budget across jobs proportional to their weights (at least one thread each).
     """
+    total = float(sum(weights.values())) or 1.0
+    shares = {k: threads * w / total for k, w in weights.items()}
+    budget = {k: max(1, int(v)) for k, v in shares.items()}
+    left = threads - sum(budget.values())
+    for k in sorted(shares, key=lambda k: shares[k] - int(shares[k]), reverse=True):
+        if left <= 0:
+            break
+        budget[k] += 1
+        left -= 1
+    return budget
+
+
+def fastq_run_ids(fastq_files):
+    """Sequencing run id (instrument_run_flowcell) of each sample from the first header of its R1 fastq file.
+
+    Samples without an illumina 1.8+ header get None.
     """
-    tables, seqs, stats = {}, {}, {}
-    for region, data in adata.items():
-        write_message('denoising region {}'.format(region))
+    runs = {}
+    for fn in fastq_files:
+        with open_fastq(fn) as fh:
+            header = fh.readline()
+        fields = header[1:].split()[0].split(':') if header.strip() else []
+        runs[basename(fn).split('_R1.fastq')[0]] = '_'.join(fields[:3]) if len(fields) >= 7 else None
+    return runs
+
+
+def region_fastq_dir(demux):
+    """Directory of per sample fastq.gz files of a SampleData[PairedEndSequencesWithQuality] artifact.
+    """
+    from q2_types.per_sample_sequences import SingleLanePerSamplePairedEndFastqDirFmt
+    return str(demux.view(SingleLanePerSamplePairedEndFastqDirFmt).path)
+
+
+def error_model_subsample(adata, outdir, n_reads=1000000, samples=None):
+    """Stratified subsample of all regions and samples (default all) for error model learning.
+
+    The first reads of every region/sample file are taken in equal shares of `n_reads`.
+    """
+    files = []
+    for region, demux in adata.items():
+        for fn in sorted(glob.glob(join(region_fastq_dir(demux), '*_R1_001.fastq.gz'))):
+            if samples is None or basename(fn).rsplit('_{}_S0_L001'.format(region), 1)[0] in samples:
+                files.append(fn)
+    per_file = max(1, n_reads // max(1, len(files)))
+    out = []
+    for read in ['R1', 'R2']:
+        fn_out = join(outdir, 'subsample_{}.fastq.gz'.format(read))
+        with open_fastq_writer(fn_out) as out_fh:
+            for fn in files:
+                with open_fastq(fn.replace('_R1_001.fastq.gz', '_{}_001.fastq.gz'.format(read))) as fh:
+                    for rec in itertools.islice(read_fastq(fh), per_file):
+                        out_fh.write(format_fastq(*rec))
+        out.append(fn_out)
+    return out
+
+
+def dada2_script_args(trunc_len_f=0, trunc_len_r=0, trim_left_f=0, trim_left_r=0, max_ee_f=6.0, max_ee_r=6.0, trunc_q=2,
+                      threads=1, **kwargs):
+    return [str(i) for i in [trunc_len_f, trunc_len_r, trim_left_f, trim_left_r, max_ee_f, max_ee_r, trunc_q, threads]]
+
+
+def learn_error_model(adata, run_id, cache_dir, samples=None, n_reads=1000000, threads=4, **params):
+    """Learn forward/reverse dada2 error models once per sequencing run.
+
+    Models are learned from a stratified subsample across regions and the `samples` of the run, and cached as
+    `<cache_dir>/<run_id>_<params hash>.rds`, which is reused by every region and later runs.
+    """
+    filter_params = dada2_script_args(**params)[:-1]
+    fn = join(cache_dir, '{}_{}.rds'.format(run_id, stage_key(filter_params, n_reads)[:10]))
+    if exists(fn):
+        write_message('using cached dada2 error model {}'.format(fn))
+        return fn
+    os.makedirs(cache_dir, exist_ok=True)
+    tmpdir = mkdtemp()
+    with profile('learn_errors', threads=threads):
+        R1, R2 = error_model_subsample(adata, tmpdir, n_reads=n_reads, samples=samples)
+        cmd = ['Rscript', DADA2_SCRIPT, 'learn', R1, R2, fn + '.tmp'] + dada2_script_args(threads=threads, **params)
+        subprocess.check_call(cmd)
+        os.rename(fn + '.tmp', fn)
+    shutil.rmtree(tmpdir)
+    return fn
+
+
+def shared_error_models(adata, run_ids, cache_dir, outdir, threads=4, **params):
+    """Error model of each sequencing run (see `learn_error_model`) of a dict of sample: run id.
+
+    Returns the model file if all samples are from one run, else a tsv of region sample id and model file
+    of its run (see dada2_paired.R). Returns None if the run of a sample is unknown.
+    """
+    if not run_ids or None in run_ids.values():
+        return None
+    models = {}
+    for run in sorted(set(run_ids.values())):
+        samples = set(s for s, r in run_ids.items() if r == run)
+        models[run] = learn_error_model(adata, run, cache_dir, samples=samples, threads=threads, **params)
+    if len(models) == 1:
+        return list(models.values())[0]
+    fn = join(outdir, 'error_models.tsv')
+    with open(fn, 'w') as fh:
+        fh.write('sample-id\terror-model\n')
+        for region in adata.keys():
+            for sample, run in sorted(run_ids.items()):
+                fh.write('{}_{}\t{}\n'.format(sample, region, models[run]))
+    return fn
+
+
+def dereplicate_region(demux, outdir, threads=1, trim_left_f=0, trim_left_r=0, trunc_len_f=0, trunc_len_r=0,
+                       max_ee_f=6.0, max_ee_r=6.0, trunc_q=2, **kwargs):
+    """Filter and dereplicate the read pairs of a region per sample (see dereplicate.py).
+
+    Runs as a separate process, as region workers are daemonic pool processes.
+    """
+    cmd = [sys.executable, DEREPLICATE_SCRIPT, region_fastq_dir(demux), '--output-dir', outdir, '--threads', str(threads),
+           '--trim-left', '{},{}'.format(trim_left_f, trim_left_r), '--trunc-len', '{},{}'.format(trunc_len_f, trunc_len_r),
+           '--max-ee', '{},{}'.format(max_ee_f, max_ee_r), '--trunc-q', str(trunc_q)]
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+    return outdir
+
+
+def dada2_artifacts(seqtab, stats):
+    """Table, sequence and stats artifacts (as dada2 denoise-paired with hashed feature ids) of a sequences x samples
+    count table and a samples x read counts table.
+    """
+    import biom
+    import skbio
+    ids = [hashlib.md5(seq.encode('utf-8')).hexdigest() for seq in seqtab.index]
+    table = biom.Table(seqtab.values, observation_ids=ids, sample_ids=[str(i) for i in seqtab.columns])
+    seqs = pd.Series([skbio.DNA(seq, metadata={'id': i}) for seq, i in zip(seqtab.index, ids)], index=ids)
+    stats = stats.rename(columns={'non.chimeric': 'non-chimeric'})
+    for col, name in [('filtered', 'passed filter'), ('merged', 'merged'), ('non-chimeric', 'non-chimeric')]:
+        pos = stats.columns.get_loc(col) + 1
+        stats.insert(pos, 'percentage of input ' + name, (100 * stats[col] / stats['input'].clip(lower=1)).round(2))
+    stats.index = stats.index.astype(str)
+    stats.index.name = 'sample-id'
+    return (Artifact.import_data('FeatureTable[Frequency]', table),
+            Artifact.import_data('FeatureData[Sequence]', seqs),
+            Artifact.import_data('SampleData[DADA2Stats]', Metadata(stats)))
+
+
+def dada2_shard_worker(files, error_model, outdir, priors, final, params):
+    """Sample inference of a shard of dereplicated samples (`sample` mode of dada2_paired.R), one thread.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    cmd = ['Rscript', DADA2_SCRIPT, 'sample', error_model, outdir, priors or 'none']
+    cmd += dada2_script_args(threads=1, **params) + ['0', 'final' if final else 'first'] + files
+    subprocess.check_call(cmd)
+
+
+def pseudo_pool_priors(first_dir, prefix, min_samples=2):
+    """Write the ASVs found in at least `min_samples` samples of a first sample inference pass as priors.
+
+    Same selection as dada2 pseudo-pooling (PSEUDO_PREVALENCE), forward and reverse reads separately.
+    """
+    for direction in ['F', 'R']:
+        prevalence = collections.Counter()
+        for fn in glob.glob(join(first_dir, '*.{}.txt'.format(direction))):
+            with open(fn) as fh:
+                prevalence.update(set(line.strip() for line in fh if line.strip()))
+        with open('{}.{}.txt'.format(prefix, direction), 'w') as fh:
+            for seq, n in prevalence.items():
+                if n >= min_samples:
+                    fh.write(seq + '\n')
+    return prefix
+
+
+def denoise_per_sample(demux, error_model, n_threads=1, min_fold_parent_over_abundance=1.0, pooling_method='pseudo',
+                       **params):
+    """Denoise a region sample by sample with a precomputed error model (see `learn_error_model`).
+
+    Read pairs are dereplicated per sample (see `dereplicate_region`) and split into shards of samples, balanced by
+    file size, which run as one threaded dada2 process each. With pseudo pooling, ASVs found in a first pass are fed
+    back as priors to a second pass. Shards are merged into one table before chimera removal. Shards run in a thread
+    pool, as region workers are daemonic pool processes.
+    Returns table, sequence and stats artifacts.
+    """
+    from multiprocessing.pool import ThreadPool
+    if pooling_method not in ['pseudo', 'independent']:
+        raise ValueError('per sample denoising does not support pooling method {}'.format(pooling_method))
+    outdir = mkdtemp()
+    derep_dir = dereplicate_region(demux, join(outdir, 'derep'), threads=n_threads, **params)
+    files = sorted(glob.glob(join(derep_dir, '*.derep.gz')), key=os.path.getsize, reverse=True)
+    n_shards = max(1, min(n_threads, len(files)))
+    shards = [files[i::n_shards] for i in range(n_shards)]
+    priors = None
+    with ThreadPool(n_shards) as pool:
+        if pooling_method == 'pseudo':
+            first_dir = join(outdir, 'first')
+            pool.starmap(dada2_shard_worker, [(shard, error_model, first_dir, None, False, params) for shard in shards])
+            priors = pseudo_pool_priors(first_dir, join(outdir, 'priors'))
+        final_dir = join(outdir, 'final')
+        pool.starmap(dada2_shard_worker, [(shard, error_model, final_dir, priors, True, params) for shard in shards])
+
+    counts, stats = {}, {}
+    for fn in sorted(glob.glob(join(final_dir, '*.counts.tsv'))):
+        sample = basename(fn)[:-len('.counts.tsv')]
+        stats[sample] = pd.read_csv(fn, sep='\t').iloc[0]
+        merged_fn = join(final_dir, sample + '.merged.tsv')
+        if exists(merged_fn):
+            merged = pd.read_csv(merged_fn, sep='\t')
+            counts[sample] = merged.groupby('sequence')['abundance'].sum()
+    stats = pd.DataFrame(stats).T
+    seqtab = pd.DataFrame(counts).fillna(0).astype(int)
+    seqtab.index.name = 'sequence'
+    if len(seqtab):
+        seqtab.to_csv(join(outdir, 'table.tsv'), sep='\t')
+        cmd = ['Rscript', DADA2_SCRIPT, 'chimera', join(outdir, 'table.tsv'), join(outdir, 'nochim.tsv'), '-']
+        cmd += dada2_script_args(threads=n_threads, **params) + [str(min_fold_parent_over_abundance)]
+        subprocess.check_call(cmd)
+        seqtab = pd.read_csv(join(outdir, 'nochim.tsv'), sep='\t', index_col=0)
+    shutil.rmtree(outdir)
+    stats['non.chimeric'] = seqtab.sum().reindex(stats.index).fillna(0).astype(int)
+    return dada2_artifacts(seqtab, stats)
+
+
+def denoise_paired_shared(demux, error_model, n_threads=1, min_fold_parent_over_abundance=1.0, pooling_method='independent',
+                          dereplicate=False, per_sample=False, **params):
+    """Denoise a region with a precomputed error model (see `learn_error_model`).
+
+    Same steps as dada2 denoise-paired with hashed feature ids. Returns table, sequence and stats artifacts.
+    With `dereplicate`, read pairs are filtered and dereplicated per sample (see dereplicate.py) and dada2 reads
+    the dereplicated samples instead of the fastq files. With `per_sample`, see `denoise_per_sample`.
+    """
+    if per_sample:
+        return denoise_per_sample(demux, error_model, n_threads=n_threads, pooling_method=pooling_method,
+                                  min_fold_parent_over_abundance=min_fold_parent_over_abundance, **params)
+    outdir = mkdtemp()
+    input_dir = region_fastq_dir(demux)
+    if dereplicate:
+        input_dir = join(outdir, 'derep')
+        dereplicate_region(demux, input_dir, threads=n_threads, **params)
+    cmd = ['Rscript', DADA2_SCRIPT, 'denoise', input_dir, error_model, outdir]
+    cmd += dada2_script_args(threads=n_threads, **params) + [str(min_fold_parent_over_abundance), pooling_method]
+    subprocess.check_call(cmd)
+    seqtab = pd.read_csv(join(outdir, 'table.tsv'), sep='\t', index_col=0)
+    stats = pd.read_csv(join(outdir, 'stats.tsv'), sep='\t', index_col=0)
+    shutil.rmtree(outdir)
+    return dada2_artifacts(seqtab, stats)
+
+
+_DENOISE_DATA = {}
+
+def dada2_worker(region, outdir, n_threads, params, error_model=None):
+    """Denoise one region and save the results in `outdir`.
+
+    Input data is read from the module level `_DENOISE_DATA` which is shared with forked workers.
+    Returns a dict of saved file names (empty if denoising failed) and the profile record of the worker.
+    """
+    write_message('denoising region {} ({} threads)'.format(region, n_threads))
+    out = {}
+    with profile('denoise', region=region, threads=n_threads) as record:
         try:
-            res = dada2.methods.denoise_paired(data, trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r,
-                                               trim_left_f=trim_left_f, trim_left_r=trim_left_r,
-                                               max_ee_f=max_ee_f, max_ee_r=max_ee_r, trunc_q=trunc_q,
-                                               min_fold_parent_over_abundance=min_fold_parent_over_abundance,
-                                               n_threads=threads, n_reads_learn=1000000, hashed_feature_ids=True)
-            tables[region], seqs[region], stats[region]  = res
+            if error_model:
+                res = denoise_paired_shared(_DENOISE_DATA[region], error_model, n_threads=n_threads, **params)
+            else:
+                res = dada2.methods.denoise_paired(_DENOISE_DATA[region], n_threads=n_threads, n_reads_learn=1000000,
+                                                   hashed_feature_ids=True, **params)
+            for name, data in zip(['table', 'seqs', 'stats'], res):
+                out[name] = data.save(join(outdir, '{}_{}.qza'.format(region, name)))
+            write_message('completed denoising region {}'.format(region))
         except Exception as inst:
             print('skipping ' + region)
             print(inst)
-        write_message('completed denoising region {}'.format(region))
+    out['profile'] = record
+    return out
+
+
+def denoise_dada2(adata, read_counts=None, trunc_len_f=0, trunc_len_r=0, trim_left_f=0, trim_left_r=0, max_ee_f=6.0, max_ee_r=6.0, trunc_q=2,
+                  min_fold_parent_over_abundance=1.0, threads=4, pooling_method='independent', error_model=None,
+                  dereplicate=False, per_sample=False):
+    """Denoise regions concurrently.
+
+    The thread budget is split across regions weighted by their read counts, and results are
+    collected as regions finish. Failed regions are skipped. With an `error_model` (see `learn_error_model`)
+    regions skip error learning and are denoised with the shared model, optionally from dereplicated read pairs
+    or sample by sample (see `denoise_per_sample`).
+    """
+    params = dict(trunc_len_f=trunc_len_f, trunc_len_r=trunc_len_r, trim_left_f=trim_left_f, trim_left_r=trim_left_r,
+                  max_ee_f=max_ee_f, max_ee_r=max_ee_r, trunc_q=trunc_q,
+                  min_fold_parent_over_abundance=min_fold_parent_over_abundance)
+    if error_model:
+        params['pooling_method'] = pooling_method
+        params['dereplicate'] = dereplicate
+        params['per_sample'] = per_sample
+    if read_counts is not None:
+        weights = {r: int(read_counts[r].sum()) for r in adata.keys()}
+    else:
+        weights = {r: 1 for r in adata.keys()}
+    budget = thread_budget(weights, threads)
+
+    _DENOISE_DATA.update(adata)
+    outdir = mkdtemp()
+    tables, seqs, stats = {}, {}, {}
+    with mp.Pool(max(1, min(len(budget), threads))) as pool:
+        jobs = {r: pool.apply_async(dada2_worker, (r, outdir, n, params, error_model)) for r, n in budget.items()}
+        for region, job in jobs.items():
+            out = job.get()
+            PROFILE.append(out.pop('profile'))
+            if not out:
+                continue
+            tables[region] = Artifact.load(out['table'])
+            seqs[region] = Artifact.load(out['seqs'])
+            stats[region] = Artifact.load(out['stats'])
+    _DENOISE_DATA.clear()
+    shutil.rmtree(outdir)
     return tables, seqs, stats
 
 
 def dada2_summary(tables, sequences, stats):
     summary = {}
     for r in tables.keys():
-        summary[r] = {}
-        summary[r]['sequence'] = feature_table.visualizers.tabulate_seqs(sequences[r])
-        summary[r]['table'] = feature_table.visualizers.summarize(tables[r])
-        summary[r]['stats'] = metadata.visualizers.tabulate(stats[r].view(qiime2.Metadata))
+        with profile('dada2_summary', region=r):
+            summary[r] = {}
+            summary[r]['sequence'] = feature_table.visualizers.tabulate_seqs(sequences[r])
+            summary[r]['table'] = feature_table.visualizers.summarize(tables[r])
+            summary[r]['stats'] = metadata.visualizers.tabulate(stats[r].view(qiime2.Metadata))
 
     return summary
 
 
-def taxonomy_classify(sequences, classifier_dir, primers, level='99', threads=4):
-    taxas = {}
+def classifier_identity(clf_pth):
+    """Identify a prebuilt classifier by name and a hash of the names, sizes and modification times of its files.
+
+    Files overwritten inside the classifier directory change the identity, the directory mtime does not.
+    """
+    files = [clf_pth] if os.path.isfile(clf_pth) else sorted(
+        join(root, fn) for root, dirs, fns in os.walk(clf_pth) for fn in fns)
+    md5 = hashlib.md5()
+    for fn in files:
+        st = os.stat(fn)
+        md5.update('{}\t{}\t{}\n'.format(os.path.relpath(fn, clf_pth), st.st_size, st.st_mtime_ns).encode())
+    return '{}:{}'.format(basename(clf_pth), md5.hexdigest()[:16])
+
+
+def classifier_cache_fn(clf_pth, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = join(os.path.dirname(clf_pth), 'cache')
+    return join(cache_dir, classifier_identity(clf_pth).replace(':', '.') + '.joblib')
+
+
+def load_classifier(clf_pth, cache_dir=None):
+    """Load a fitted sklearn classifier pipeline.
+
+    The pipeline is cached as an uncompressed joblib dump in `cache_dir` (default: `<classifier_dir>/cache`)
+    which is memory mapped on later loads. The cache file is named by the classifier identity (see
+    `classifier_identity`), so a changed classifier gets a new cache and replaces the old one.
+    """
+    import joblib
+    from sklearn.pipeline import Pipeline
+    cache_fn = classifier_cache_fn(clf_pth, cache_dir)
+    cache_dir = os.path.dirname(cache_fn)
+    if exists(cache_fn):
+        write_message('loading cached classifier: {}'.format(cache_fn))
+        return joblib.load(cache_fn, mmap_mode='r')
+    write_message('loading classifier: {}'.format(clf_pth))
+    pipeline = qiime2.Artifact.import_data('TaxonomicClassifier', clf_pth).view(Pipeline)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_fn = cache_fn + '.{}.tmp'.format(os.getpid())
+        joblib.dump(pipeline, tmp_fn)
+        os.replace(tmp_fn, cache_fn)
+        # caches of earlier versions of the classifier
+        stale = glob.glob(join(cache_dir, glob.escape(basename(clf_pth)) + '.' + '[0-9a-f]' * 16 + '.joblib'))
+        for fn in stale + glob.glob(join(cache_dir, glob.escape(basename(clf_pth)) + '.joblib')):
+            if fn != cache_fn:
+                os.remove(fn)
+    except OSError as inst:
+        write_message('failed to write classifier cache: {}'.format(inst))
+    return pipeline
+
+
+_CLASSIFIERS = {}
+
+def classify_worker(region, reads, confidence, read_orientation='auto'):
+    """Classify a chunk of (feature id, sequence) reads with the classifier of `region`.
+
+    Classifiers are read from the module level `_CLASSIFIERS` which is shared (copy-on-write) with forked workers.
+    Reads are classified with the python function of classify-sklearn, including its read orientation detection.
+    Returns the region and a list of (feature id, taxon, confidence).
+    """
+    from q2_feature_classifier.classifier import classify_sklearn
+    from q2_types.feature_data import DNAFASTAFormat
+    fasta = DNAFASTAFormat()
+    with fasta.open() as fh:
+        fh.write(''.join('>{}\n{}\n'.format(k, seq) for k, seq in reads))
+    res = classify_sklearn(fasta, _CLASSIFIERS[region], reads_per_batch=max(1, len(reads)), n_jobs=1,
+                           confidence=confidence, read_orientation=read_orientation)
+    return region, [(k, row['Taxon'], row['Confidence']) for k, row in res.iterrows()]
+
+
+def classify_batch(batch):
+    return classify_worker(*batch)
+
+
+def classifier_batch_size(pipeline, reads, memory_gb, workers, shared_bytes=0):
+    """Number of sequences per batch to keep `workers` concurrent batches within `memory_gb`.
+
+    A batch needs the dense class probabilities and the sparse k-mer counts of its sequences. Memory mapped
+    classifiers (`shared_bytes`) are shared by all workers and counted once.
+    """
+    mean_len = sum(len(seq) for k, seq in reads) / float(max(1, len(reads)))
+    per_seq = 8 * len(pipeline.classes_) + 12 * mean_len
+    available = memory_gb * 2 ** 30 - shared_bytes
+    if available <= 0:
+        raise ValueError('classifier memory budget of {} GB is below the classifier size'.format(memory_gb))
+    return max(1, int(available / workers / per_seq))
+
+
+def read_partial_taxonomy(fn, classifier, confidence):
+    """Assignments of an interrupted classification (see `append_partial_taxonomy`).
+
+    Returns a dict feature id -> (taxon, confidence), empty if missing or written with another classifier.
+    """
+    found = {}
+    if not exists(fn):
+        return found
+    with open(fn) as fh:
+        if fh.readline() != '# {}\t{}\n'.format(classifier, confidence):
+            return found
+        for line in fh:
+            if not line.endswith('\n'):
+                break
+            k, taxon, score = line.rstrip('\n').split('\t')
+            found[k] = (taxon, float(score))
+    return found
+
+
+def append_partial_taxonomy(fn, classifier, confidence, rows):
+    """Append taxonomy assignments (feature id, taxon, confidence) of a finished batch to a partial taxonomy file.
+    """
+    new = not exists(fn)
+    with open(fn, 'a') as fh:
+        lines = ['# {}\t{}\n'.format(classifier, confidence)] if new else []
+        lines.extend('{}\t{}\t{}\n'.format(k, taxon, score) for k, taxon, score in rows)
+        fh.write(''.join(lines))
+
+
+def taxonomy_cache_lookup(db_fn, classifier, confidence, reads):
+    """Look up cached taxonomy assignments for (feature id, sequence) reads.
+
+    Assignments are keyed by sequence md5, classifier identity and confidence threshold.
+    Returns a dict feature id -> (taxon, confidence).
+    """
+    import sqlite3
+    hashes = {hashlib.md5(seq.encode()).hexdigest(): k for k, seq in reads}
+    found = {}
+    with sqlite3.connect(db_fn, timeout=60) as con:
+        con.execute('CREATE TABLE IF NOT EXISTS taxonomy (hash TEXT, classifier TEXT, confidence REAL, '
+                    'taxon TEXT, score REAL, PRIMARY KEY (hash, classifier, confidence))')
+        keys = list(hashes.keys())
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            query = 'SELECT hash, taxon, score FROM taxonomy WHERE classifier = ? AND confidence = ? AND hash IN ({})'
+            query = query.format(','.join('?' * len(chunk)))
+            for h, taxon, score in con.execute(query, [classifier, confidence] + chunk):
+                found[hashes[h]] = (taxon, score)
+    return found
+
+
+def taxonomy_cache_store(db_fn, classifier, confidence, reads, rows):
+    """Store taxonomy assignments (feature id, taxon, confidence) of classified reads.
+    """
+    import sqlite3
+    hashes = {k: hashlib.md5(seq.encode()).hexdigest() for k, seq in reads}
+    values = [(hashes[k], classifier, confidence, taxon, float(score)) for k, taxon, score in rows]
+    with sqlite3.connect(db_fn, timeout=60) as con:
+        con.executemany('INSERT OR REPLACE INTO taxonomy VALUES (?, ?, ?, ?, ?)', values)
+
+
+def taxonomy_classify(sequences, classifier_dir, primers, level='99', confidence=0.7, cache_dir=None,
+                      taxonomy_cache=None, partial_dir=None, memory_gb=None, threads=4):
+    """Classify representative sequences of all regions concurrently.
+
+    Sequences found in the `taxonomy_cache` sqlite file are not reclassified. Classifiers are loaded once
+    (see `load_classifier`), and only for regions with unseen sequences. Unseen sequences are split into
+    chunks distributed over a process pool, with the number of chunks per region weighted by its number of sequences.
+    With `memory_gb`, chunks are sized to keep all workers within the memory budget (see `classifier_batch_size`).
+    Finished chunks are appended to `<partial_dir>/<region>.tsv`, and are not reclassified if the run is restarted.
+    """
+    reads, todo, cached, clf_ids, shared_bytes = {}, {}, {}, {}, 0
     for region, repseq in sequences.items():
-        clf_name = '{}_{}'.format(level, primers[region])
-        clf_pth = join(classifier_dir, clf_name)
-        write_message('loading classifier: {}'.format(clf_pth))
-        classifier = qiime2.Artifact.import_data('TaxonomicClassifier', clf_pth)
-        write_message('starting classifier for region: {}'.format(region))
-        taxas[region] = feature_classifier.methods.classify_sklearn(reads=repseq, classifier=classifier, n_jobs=threads)
+        clf_pth = join(classifier_dir, '{}_{}'.format(level, primers[region]))
+        S = repseq.view(pd.Series)
+        reads[region] = [(str(k), str(v)) for k, v in S.items()]
+        clf_ids[region] = classifier_identity(clf_pth)
+        cached[region] = {}
+        if taxonomy_cache is not None:
+            cached[region] = taxonomy_cache_lookup(taxonomy_cache, clf_ids[region], confidence, reads[region])
+            write_message('found {} of {} sequences in taxonomy cache for region {}'.format(
+                len(cached[region]), len(reads[region]), region))
+        todo[region] = [r for r in reads[region] if r[0] not in cached[region]]
+        if todo[region]:
+            _CLASSIFIERS[region] = load_classifier(clf_pth, cache_dir=cache_dir)
+            if exists(classifier_cache_fn(clf_pth, cache_dir)):
+                shared_bytes += os.path.getsize(classifier_cache_fn(clf_pth, cache_dir))
+
+    partial, partial_fn = {}, {}
+    if partial_dir is not None:
+        os.makedirs(partial_dir, exist_ok=True)
+    for region in reads.keys():
+        partial[region] = {}
+        if partial_dir is not None:
+            partial_fn[region] = join(partial_dir, '{}.tsv'.format(region))
+            partial[region] = read_partial_taxonomy(partial_fn[region], clf_ids[region], confidence)
+            if not partial[region] and exists(partial_fn[region]):
+                os.remove(partial_fn[region])
+            if partial[region]:
+                write_message('found {} classified sequences of an earlier run for region {}'.format(
+                    len(partial[region]), region))
+            todo[region] = [r for r in todo[region] if r[0] not in partial[region]]
+    budget = thread_budget({r: len(v) for r, v in todo.items()}, threads)
+
+    batches = []
+    for region, R in todo.items():
+        if memory_gb is not None and R:
+            size = classifier_batch_size(_CLASSIFIERS[region], R, memory_gb, max(1, threads), shared_bytes)
+            write_message('classifying region {} in batches of {} sequences'.format(region, size))
+        else:
+            size = max(1, -(-len(R) // budget[region]))
+        batches.extend((region, R[i:i + size], confidence) for i in range(0, len(R), size))
+
+    write_message('starting classifier for regions: {}'.format(', '.join(reads.keys())))
+    rows = {region: [] for region in reads.keys()}
+    with mp.Pool(max(1, threads)) as pool:
+        for region, res in pool.imap_unordered(classify_batch, batches):
+            rows[region].extend(res)
+            if partial_dir is not None:
+                append_partial_taxonomy(partial_fn[region], clf_ids[region], confidence, res)
+    _CLASSIFIERS.clear()
+
+    taxas = {}
+    for region in reads.keys():
+        new = rows[region] + [(k, taxon, score) for k, (taxon, score) in partial[region].items()]
+        if taxonomy_cache is not None and new:
+            taxonomy_cache_store(taxonomy_cache, clf_ids[region], confidence, reads[region], new)
+        new.extend((k, taxon, score) for k, (taxon, score) in cached[region].items())
+        df = pd.DataFrame(new, columns=['Feature ID', 'Taxon', 'Confidence']).set_index('Feature ID')
+        df = df.loc[[k for k, seq in reads[region]]]
+        taxas[region] = Artifact.import_data('FeatureData[Taxonomy]', df)
+        if region in partial_fn and exists(partial_fn[region]):
+            os.remove(partial_fn[region])
         write_message('completed classification for {}'.format(region))
     return taxas
 
@@ -264,79 +806,171 @@ def region_sample_info(samples, region):
 def taxonomy_summary(taxas, sequences, samples):
     summary = {}
     for r in taxas.keys():
-        samples_region = region_sample_info(samples, r)
-        summary[r] = {}
-        summary[r]['taxa'] = metadata.visualizers.tabulate(taxas[r].classification.view(qiime2.Metadata))
-        summary[r]['taxa_bar'] = taxa.visualizers.barplot(sequences[r], taxas[r].classification, samples_region)
+        with profile('taxonomy_summary', region=r):
+            samples_region = region_sample_info(samples, r)
+            summary[r] = {}
+            summary[r]['taxa'] = metadata.visualizers.tabulate(taxas[r].view(qiime2.Metadata))
+            summary[r]['taxa_bar'] = taxa.visualizers.barplot(sequences[r], taxas[r], samples_region)
     return summary
 
 
+def concat_tables(tables):
+    """Concatenate biom tables with disjoint features into one sparse table over the union of samples.
+    """
+    import biom
+    import numpy as np
+    from scipy import sparse
+    sample_idx = collections.OrderedDict()
+    for T in tables:
+        for i in T.ids('sample'):
+            sample_idx.setdefault(i, len(sample_idx))
+    sample_ids = list(sample_idx.keys())
+    blocks, obs_ids = [], []
+    for T in tables:
+        M = T.matrix_data.tocoo()
+        cols = np.array([sample_idx[k] for k in T.ids('sample')], dtype=int)
+        M = sparse.coo_matrix((M.data, (M.row, cols[M.col])), shape=(M.shape[0], len(sample_ids)))
+        blocks.append(M.tocsr())
+        obs_ids.extend(T.ids('observation'))
+    if len(set(obs_ids)) < len(obs_ids):
+        raise ValueError('overlapping feature ids across regions!')
+    return biom.Table(sparse.vstack(blocks, format='csr'), obs_ids, sample_ids)
+
+
 def merge_data(tables, taxas, sequences, samples):
+    """Merge region tables, taxonomies and sequences.
+
+    Tables are kept as sparse biom tables throughout, region suffixes are stripped from the sample ids.
+    """
+    import biom
     taxa_list = []
     table_list = []
     seq_list = []
-    meta_region = []
+    feature_region = {}
     # ensure same ordering of dicts
     for r in taxas.keys():
-        taxa_list.append(taxas[r].classification)
-        df = tables[r].view(pd.DataFrame)
-        df.index = df.index.str.replace('_{}'.format(r), '')
-        meta_region.extend([r] * df.shape[1])
-        table = Artifact.import_data('FeatureTable[Frequency]', df)
-        table_list.append(table)
+        taxa_list.append(taxas[r])
+        T = tables[r].view(biom.Table)
+        sample_ids = [i.replace('_{}'.format(r), '') for i in T.ids('sample')]
+        table_list.append(biom.Table(T.matrix_data, T.ids('observation'), sample_ids))
+        feature_region.update((i, r) for i in T.ids('observation'))
         seq_list.append(sequences[r])
-    merged_taxa = feature_table.methods.merge_taxa(taxa_list)
-    merged_seq = feature_table.methods.merge_seqs(seq_list)
-    merged_table = feature_table.methods.merge(
-        table_list, overlap_method='error_on_overlapping_feature'
-    )
+    merged_taxa = feature_table.methods.merge_taxa(taxa_list).merged_data
+    merged_seq = feature_table.methods.merge_seqs(seq_list).merged_data
+    merged = concat_tables(table_list)
+    merged_table = Artifact.import_data('FeatureTable[Frequency]', merged)
 
     #
-    meta = pd.DataFrame(meta_region)
-    meta.index = merged_table.merged_table.view(pd.DataFrame).columns
-    meta.index.name = 'feature-id'
-    meta.columns = ['region']
+    meta = pd.DataFrame({'region': [feature_region[i] for i in merged.ids('observation')]},
+                        index=pd.Index(merged.ids('observation'), name='feature-id'))
     meta = Metadata(meta)
 
 
     return merged_table, merged_taxa, merged_seq, meta
 
 
+def merge_tables(tables):
+    """Sum biom tables over the union of samples and features (feature-table merge with overlap method `sum`).
+    """
+    import biom
+    import numpy as np
+    from scipy import sparse
+    sample_idx, obs_idx = collections.OrderedDict(), collections.OrderedDict()
+    for T in tables:
+        for i in T.ids('sample'):
+            sample_idx.setdefault(i, len(sample_idx))
+        for i in T.ids('observation'):
+            obs_idx.setdefault(i, len(obs_idx))
+    rows, cols, data = [], [], []
+    for T in tables:
+        M = T.matrix_data.tocoo()
+        rows.append(np.array([obs_idx[k] for k in T.ids('observation')], dtype=int)[M.row])
+        cols.append(np.array([sample_idx[k] for k in T.ids('sample')], dtype=int)[M.col])
+        data.append(M.data)
+    M = sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                          shape=(len(obs_idx), len(sample_idx))).tocsr()
+    nonzero = np.flatnonzero(np.asarray(M.sum(axis=1)).ravel() > 0)
+    obs_ids = list(obs_idx.keys())
+    return biom.Table(M[nonzero], [obs_ids[i] for i in nonzero], list(sample_idx.keys()))
+
+
+def load_project(project_dir):
+    """Merged table, taxonomy, sequence, feature regions, sample info and merged runs of a project (see `save_project`).
+
+    Returns None if `project_dir` has no saved project.
+    """
+    names = ['table', 'taxonomy', 'sequence']
+    files = [join(project_dir, n + '.qza') for n in names] + [join(project_dir, n) for n in
+                                                                ['feature_region.tsv', 'sample_info.tsv', 'runs.json']]
+    if not all(exists(fn) for fn in files):
+        return None
+    project = {n: Artifact.load(join(project_dir, n + '.qza')) for n in names}
+    project['meta_region'] = Metadata.load(join(project_dir, 'feature_region.tsv'))
+    project['samples'] = Metadata.load(join(project_dir, 'sample_info.tsv'))
+    with open(join(project_dir, 'runs.json')) as fh:
+        project['runs'] = json.load(fh)
+    return project
+
+
+def save_project(project_dir, table, taxonomy, sequence, meta_region, samples, runs):
+    """Save the merged (unfiltered) data of all runs of a project for later incremental runs.
+    """
+    os.makedirs(project_dir, exist_ok=True)
+    for name, data in [('table', table), ('taxonomy', taxonomy), ('sequence', sequence)]:
+        data.save(join(project_dir, name + '.tmp.qza'))
+        os.replace(join(project_dir, name + '.tmp.qza'), join(project_dir, name + '.qza'))
+    meta_region.save(join(project_dir, 'feature_region.tsv'))
+    samples.save(join(project_dir, 'sample_info.tsv'))
+    with open(join(project_dir, 'runs.json'), 'w') as fh:
+        json.dump(runs, fh)
+
+
+def merge_project(project, table, taxonomy, sequence, meta_region, samples, overlap_method='error'):
+    """Merge the data of a new run into the project data.
+
+    Tables are merged over the union of samples and features. Samples already in the project raise an error
+    (`error`), are summed (`sum`) or replaced by the new run (`replace`). Taxonomy, sequences, feature regions
+    and sample info of features/samples already in the project are kept from the project (as feature-table merge-taxa/merge-seqs).
+    """
+    import biom
+    T_prev = project['table'].view(biom.Table)
+    T = table.view(biom.Table)
+    overlap = set(T_prev.ids('sample')) & set(T.ids('sample'))
+    if overlap and overlap_method == 'error':
+        raise ValueError('samples already in project: {}'.format(', '.join(sorted(overlap))))
+    if overlap and overlap_method == 'replace':
+        T_prev = T_prev.filter(list(overlap), axis='sample', invert=True, inplace=False)
+    merged = merge_tables([T_prev, T])
+    feature_ids = merged.ids('observation')
+
+    def union(prev, new):
+        df = pd.concat([prev, new[~new.index.isin(prev.index)]])
+        return df.reindex(feature_ids)
+    X = union(project['taxonomy'].view(pd.DataFrame), taxonomy.view(pd.DataFrame))
+    S = union(project['sequence'].view(pd.Series), sequence.view(pd.Series))
+    M = union(project['meta_region'].to_dataframe(), meta_region.to_dataframe())
+    prev_samples, new_samples = project['samples'].to_dataframe(), samples.to_dataframe()
+    samples = pd.concat([prev_samples[~prev_samples.index.isin(new_samples.index)], new_samples], sort=False)
+    return (Artifact.import_data('FeatureTable[Frequency]', merged), Artifact.import_data('FeatureData[Taxonomy]', X),
+            Artifact.import_data('FeatureData[Sequence]', S), Metadata(M), Metadata(samples))
+
+
 def filter_features(table, taxonomy, sequence, db, min_confidence):
     """Filter out features without phylum classification, low confidence or matching mitochondria/chloroplast.
     """
-    T = table.merged_table.view(pd.DataFrame)
-    X = taxonomy.merged_data.view(pd.DataFrame)
-    S = sequence.merged_data.view(pd.Series)
-
-    tx = X.Taxon.copy()
-    if db == 'silva':
-        has_phylum = X.Taxon.str.contains('D_1__')
-        # rm some useless taxonomy
-        tx = tx.str.replace('Ambiguous_taxa', '')
-        tx = tx.str.replace('D_\d__unidentified', '', regex=True)
-        #tx = tx.str.replace('\\;D_\d__unidentified$', '', regex=True)
-        X.loc[:,"Taxon"] = tx
-    elif db == 'greengenes':
-        has_phylum = X.Taxon.str.contains('p__')
-        tx = tx.str.replace('[a-z]__unidentified', '', regex=True)
-    elif db == 'unite':
-        has_phylum = X.Taxon.str.contains('p__')
-        tx = tx.str.replace('[a-z]__unidentified', '', regex=True)
-    else:
-        print('ERROR: db not valid!')
-        sys.exit(-1)
+    import biom
+    T = table.view(biom.Table)
+    X = taxonomy.view(pd.DataFrame)
+    S = sequence.view(pd.Series)
 
-    out = (X.Confidence.astype('d') < min_confidence) | \
-          X.Taxon.str.contains('chloroplast', flags=re.IGNORECASE) | \
-          X.Taxon.str.contains('mitochondria', flags=re.IGNORECASE) | \
-          (has_phylum == False)
-    keep = out == False
+    keep, taxon = taxonomy_mask(X, db, min_confidence=min_confidence)
+    X.loc[:, 'Taxon'] = taxon
 
     print("Before filtering: {} features".format(X.shape[0]))
     print("After filtering: {} features".format(sum(keep)))
 
-    table = Artifact.import_data('FeatureTable[Frequency]', T.loc[:,keep] )
+    T = T.filter(X.index[keep], axis='observation', inplace=False)
+    table = Artifact.import_data('FeatureTable[Frequency]', T)
     taxonomy = Artifact.import_data('FeatureData[Taxonomy]', X[keep])
     sequence = Artifact.import_data('FeatureData[Sequence]', S[keep])
 
@@ -353,65 +987,299 @@ def summary_data(table, taxonomy, sequence, samples):
 
 
 def build_phylogenetic_tree(sequence, threads):
+    """De novo tree with mafft, mask, fasttree and midpoint rooting. Returns the (unmasked) alignment and rooted tree.
+    """
     mafft_alignment = alignment.methods.mafft(sequence, n_threads=threads)
     masked_mafft_alignment = alignment.methods.mask(mafft_alignment.alignment)
     unrooted_tree = phylogeny.methods.fasttree(masked_mafft_alignment.masked_alignment, n_threads=threads)
     rooted_tree = phylogeny.methods.midpoint_root(unrooted_tree.tree)
-    return rooted_tree
+    return mafft_alignment.alignment, rooted_tree.rooted_tree
+
+
+def mafft_add(sequences, reference, threads=1):
+    """Align sequences against a reference alignment without changing its columns (mafft --add --keeplength).
+
+    `sequences` and `reference` are pandas series of skbio DNA. Returns the aligned sequences.
+    """
+    import skbio
+    tmpdir = mkdtemp()
+    fnames = {}
+    for name, seqs in [('reference', reference), ('new', sequences)]:
+        fnames[name] = join(tmpdir, name + '.fasta')
+        with open(fnames[name], 'w') as fh:
+            for fid, seq in seqs.items():
+                fh.write('>{}\n{}\n'.format(fid, str(seq)))
+    out_fn = join(tmpdir, 'aligned.fasta')
+    with open(out_fn, 'w') as fh:
+        subprocess.check_call(['mafft', '--preservecase', '--inputorder', '--thread', str(threads), '--keeplength',
+                               '--add', fnames['new'], fnames['reference']], stdout=fh, stderr=subprocess.DEVNULL)
+    aligned = {seq.metadata['id']: seq for seq in skbio.io.read(out_fn, format='fasta', constructor=skbio.DNA)}
+    shutil.rmtree(tmpdir)
+    return pd.Series([aligned[fid] for fid in sequences.index], index=sequences.index)
+
+
+def place_features(tree, reference, aligned):
+    """Insert aligned features into a tree next to their closest reference tip.
+
+    Distance is the p-distance over columns without gaps in either sequence. A new tip is attached to the branch
+    of its closest tip, both at half the distance from a new internal node. This is a greedy placement,
+    a full rebuild (`build_phylogenetic_tree`) gives the de novo topology.
+    """
+    import numpy as np
+    import skbio
+    tips = {tip.name: tip for tip in tree.tips()}
+    reference = reference[reference.index.isin(list(tips.keys()))]
+    as_array = lambda seqs: np.vstack([np.frombuffer(str(s).upper().encode(), dtype=np.uint8) for s in seqs])
+    R = as_array(reference.values)
+    R_gap = (R == ord('-')) | (R == ord('.'))
+    for fid, seq in aligned.items():
+        x = as_array([seq])[0]
+        valid = ~R_gap & ~((x == ord('-')) | (x == ord('.')))
+        dist = ((R != x) & valid).sum(axis=1) / np.maximum(valid.sum(axis=1), 1)
+        i = int(dist.argmin())
+        tip, d = tips[reference.index[i]], float(dist[i])
+        length = tip.length or 0.0
+        h = min(d / 2.0, length)
+        node = skbio.TreeNode(length=length - h)
+        parent = tip.parent
+        parent.remove(tip)
+        parent.append(node)
+        tip.length = h
+        node.append(tip)
+        node.append(skbio.TreeNode(name=fid, length=d / 2.0))
+    tree.invalidate_caches()
+    return tree
+
+
+def update_phylogenetic_tree(sequence, reference_dir, threads=1, rebuild=False):
+    """Phylogenetic tree of features from a project reference alignment and tree.
+
+    Features not in the reference are aligned against the reference alignment (`mafft_add`) and placed in the
+    reference tree (`place_features`), and the reference is updated. The reference is built de novo if missing or
+    if `rebuild` is set. Returns the rooted tree of the features in `sequence`.
+    """
+    import skbio
+    aln_fn, tree_fn = join(reference_dir, 'alignment.qza'), join(reference_dir, 'tree.qza')
+    if rebuild or not (exists(aln_fn) and exists(tree_fn)):
+        write_message('building reference tree de novo')
+        aln, tree = build_phylogenetic_tree(sequence, threads)
+        os.makedirs(reference_dir, exist_ok=True)
+        aln.save(aln_fn)
+        tree.save(tree_fn)
+        return tree
+
+    seqs = sequence.view(pd.Series)
+    reference = Artifact.load(aln_fn).view(pd.Series)
+    tree = Artifact.load(tree_fn).view(skbio.TreeNode)
+    new = seqs[~seqs.index.isin(reference.index)]
+    if len(new) > 0:
+        write_message('placing {} new features in reference tree of {} features'.format(len(new), len(reference)))
+        aligned = mafft_add(new, reference, threads=threads)
+        place_features(tree, reference, aligned)
+        reference = pd.concat([reference, aligned])
+        for fn, data in [(aln_fn, Artifact.import_data('FeatureData[AlignedSequence]', reference)),
+                         (tree_fn, Artifact.import_data('Phylogeny[Rooted]', tree))]:
+            data.save(fn + '.tmp.qza')
+            os.replace(fn + '.tmp.qza', fn)
+    return Artifact.import_data('Phylogeny[Rooted]', tree.shear(list(seqs.index)))
 
 
 def create_biom(table, taxonomy, sequence, features_meta=None, samples_meta=None):
+    """Create a biom table with taxonomy, feature and sample metadata.
+
+    Metadata is built column-wise and aligned to the table ids in bulk, taxonomy is stored as a
+    list of ranks.
+    """
     import biom
     from datetime import datetime
     T = table.view(biom.Table)
-    T.type = 'OTU table'
-    T.create_date = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+    obs_ids = T.ids('observation')
+    sample_ids = T.ids('sample')
 
-    FEATURES = taxonomy.view(pd.DataFrame)
+    FEATURES = taxonomy.view(pd.DataFrame).reindex(obs_ids)
     FEATURES.columns = ['taxonomy', 'confidence']
-    tax_table = FEATURES.taxonomy.str.split(';', expand=True)
-
-    md_taxa = FEATURES.to_dict(orient='index')
-    for k, v in md_taxa.items():
-        v['taxonomy'] = list(tax_table.loc[k,:])
+    FEATURES['taxonomy'] = FEATURES.taxonomy.str.split(';').map(lambda x: [i.strip() for i in x])
+    if features_meta:
+        FEATURES = FEATURES.join(features_meta.to_dataframe())
+    md_features = FEATURES.to_dict(orient='records')
 
-    T.add_metadata(md_taxa, axis='observation')
+    md_samples = None
     if samples_meta:
-        SAMPLES = samples_meta.to_dataframe()
+        SAMPLES = samples_meta.to_dataframe().reindex(sample_ids)
         # be gentle with json parsers and rm nan
-        SAMPLES.fillna(value='', inplace=True)
-        md_samples = SAMPLES.to_dict(orient='index')
-        T.add_metadata(md_samples, axis='sample')
-    if features_meta:
-        md_features = features_meta.to_dataframe().to_dict(orient='index')
-        T.add_metadata(md_features, axis='observation')
-    return T
+        SAMPLES = SAMPLES.astype(object).where(SAMPLES.notnull(), '')
+        md_samples = SAMPLES.to_dict(orient='records')
+
+    return biom.Table(T.matrix_data, obs_ids, sample_ids, observation_metadata=md_features,
+                      sample_metadata=md_samples, type='OTU table',
+                      create_date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
 
 
-def calc_diversity_region(tables, sample_meta=None, threads=8, metrics=['observed_otus', 'shannon'], max_depth=None):
+def write_biom_hdf5(biom_table, fn, generated_by='GCF qiime2 pipeline'):
+    """Write biom table in HDF5 format.
+
+    Sample metadata values are written as strings as HDF5 columns need a single type.
+    """
+    import biom
+    from biom.util import biom_open
+    md_samples = biom_table.metadata(axis='sample')
+    if md_samples is not None:
+        md_samples = [{k: str(v) for k, v in md.items()} for md in md_samples]
+    T = biom.Table(biom_table.matrix_data, biom_table.ids('observation'), biom_table.ids('sample'),
+                   observation_metadata=biom_table.metadata(axis='observation'), sample_metadata=md_samples,
+                   type=biom_table.type, create_date=biom_table.create_date)
+    with biom_open(fn, 'w') as fh:
+        T.to_hdf5(fh, generated_by)
+
+
+def calc_diversity_region(tables, threads=8, metrics=['observed_otus', 'shannon'], max_depth=None, steps=20, iterations=30):
+    """Alpha rarefaction of each region table (see rarefaction.py).
+
+    The default max depth is half of the median sample depth of the region.
+    """
+    import biom
+    import numpy as np
     diversity_res = {}
     for region, data in tables.items():
-        metadata = region_sample_info(samples, region)
-        # res = diversity.actions.core_metrics(data, sampling_depth=sampling_depth, metadata=metadata, with_replacement=True, n_jobs=threads)
-        if max_depth is None:
-            max_depth = int(data.view(pd.DataFrame).sum(1).median() / 2.0)
-            print(max_depth)
-        res = diversity.actions.alpha_rarefaction(data, max_depth=max_depth, metrics=set(metrics),
-                                                  metadata=metadata, steps=20, iterations=30)
-        diversity_res[region] = res
+        T = data.view(biom.Table)
+        depth = max_depth or max(1, int(np.median(T.sum('sample')) / 2.0))
+        with profile('alpha_rarefaction', region=region, threads=threads):
+            diversity_res[region] = alpha_rarefaction(T, rarefaction_depths(depth, steps=steps), iterations=iterations,
+                                                      metrics=metrics, threads=threads)
     return diversity_res
 
 
-def write_data(table, taxonomy, sequence, adata, biom_table, denoise_viz_region, taxa_viz_region, summary):
+@functools.lru_cache()
+def code_version():
+    """Hash of the pipeline scripts (this script and its helper modules).
+    """
+    md5 = hashlib.md5(__version__.encode())
+    script_dir = os.path.dirname(abspath(__file__))
+    for fn in sorted(glob.glob(join(script_dir, '*.py')) + glob.glob(join(script_dir, '*.R'))):
+        with open(fn, 'rb') as fh:
+            md5.update(fh.read())
+    return md5.hexdigest()
+
+
+def stage_key(*parts):
+    """Hash of stage inputs and parameters, and the code version.
+    """
+    return hashlib.md5(json.dumps([code_version(), parts], sort_keys=True, default=str).encode()).hexdigest()
+
+
+def file_signature(fnames):
+    return [(abspath(fn), os.stat(fn).st_size, os.stat(fn).st_mtime) for fn in sorted(fnames)]
+
+
+_SAVED_ARTIFACTS = {}
+
+def save_artifact(artifact, fn):
+    """Save an artifact, as hardlink of an earlier saved copy (e.g. in the stage cache) when possible.
+    """
+    if not fn.endswith('.qza'):
+        fn += '.qza'
+    if exists(fn):
+        os.remove(fn)
+    src = _SAVED_ARTIFACTS.get(str(artifact.uuid))
+    if src is not None and exists(src):
+        try:
+            os.link(src, fn)
+            return fn
+        except OSError:
+            pass
+    fn = artifact.save(fn)
+    _SAVED_ARTIFACTS[str(artifact.uuid)] = fn
+    return fn
+
+
+def load_artifact(fn):
+    artifact = Artifact.load(fn)
+    _SAVED_ARTIFACTS[str(artifact.uuid)] = fn
+    return artifact
+
+
+def save_stage(cache_dir, name, key, results):
+    """Save stage results to `<cache_dir>/<name>`.
+
+    Results is a dict of Artifacts, dicts of Artifacts (per region), Metadata or pandas DataFrames.
+    The stage index with the key is written last and marks the stage as valid. Artifacts saved here are
+    hardlinked by later saves of the same artifact (see `save_artifact`).
+    """
+    dirname = join(cache_dir, name)
+    shutil.rmtree(dirname, ignore_errors=True)
+    os.makedirs(dirname)
+    index = {}
+    for label, obj in results.items():
+        if isinstance(obj, dict):
+            files = {k: save_artifact(v, join(dirname, '{}_{}'.format(label, k))) for k, v in obj.items()}
+            index[label] = {'type': 'artifacts', 'files': files}
+        elif isinstance(obj, Metadata):
+            fn = join(dirname, label + '.tsv')
+            obj.save(fn)
+            index[label] = {'type': 'metadata', 'files': fn}
+        elif isinstance(obj, pd.DataFrame):
+            fn = join(dirname, label + '.tsv')
+            obj.to_csv(fn, sep='\t')
+            index[label] = {'type': 'dataframe', 'files': fn}
+        else:
+            index[label] = {'type': 'artifact', 'files': save_artifact(obj, join(dirname, label))}
+    with open(join(dirname, 'stage.json'), 'w') as fh:
+        json.dump({'key': key, 'results': index}, fh, indent=2)
+
+
+def load_stage(cache_dir, name, key):
+    """Load stage results saved by `save_stage`. Returns None if missing, invalid or saved with another key.
+    """
+    index_fn = join(cache_dir, name, 'stage.json')
+    if not exists(index_fn):
+        return None
+    with open(index_fn) as fh:
+        index = json.load(fh)
+    if index['key'] != key:
+        return None
+    results = {}
+    for label, res in index['results'].items():
+        files = res['files']
+        if not all(exists(fn) for fn in (files.values() if isinstance(files, dict) else [files])):
+            return None
+        if res['type'] == 'artifacts':
+            results[label] = {k: load_artifact(fn) for k, fn in files.items()}
+        elif res['type'] == 'metadata':
+            results[label] = Metadata.load(files)
+        elif res['type'] == 'dataframe':
+            results[label] = pd.read_csv(files, sep='\t', index_col=0, converters={0: str})
+        else:
+            results[label] = load_artifact(files)
+    return results
+
+
+def run_stage(name, key, func):
+    """Run a pipeline stage, or load its results from the stage cache when resuming.
+    """
+    cache_dir = join(args.output_dir, 'stage_cache')
+    with profile(name, threads=args.threads) as record:
+        if args.resume:
+            res = load_stage(cache_dir, name, key)
+            if res is not None:
+                write_message('resuming stage {} from {}'.format(name, join(cache_dir, name)))
+                record['step'] = name + ' (resumed)'
+                return res
+        res = func()
+        save_stage(cache_dir, name, key, res)
+    return res
+
+
+def write_data(table, taxonomy, sequence, adata, biom_table, denoise_viz_region, taxa_viz_region, summary, region_data=None):
     os.makedirs(args.output_dir, exist_ok=True)
 
-    table.save(join(args.output_dir, 'table'))
-    taxonomy.save(join(args.output_dir, 'taxonomy'))
-    sequence.save(join(args.output_dir, 'sequence'))
+    save_artifact(table, join(args.output_dir, 'table'))
+    save_artifact(taxonomy, join(args.output_dir, 'taxonomy'))
+    save_artifact(sequence, join(args.output_dir, 'sequence'))
 
 
     with open(join(args.output_dir, 'table.biom'), 'w') as fh:
         biom_table.to_json('GCF qiime2 pipeline', fh)
+    write_biom_hdf5(biom_table, join(args.output_dir, 'table.hdf5.biom'))
     with open(join(args.output_dir, 'table.tsv'), 'w') as fh:
         fh.write(biom_table.to_tsv())
 
@@ -431,7 +1299,12 @@ def write_data(table, taxonomy, sequence, adata, biom_table, denoise_viz_region,
 
     for region, data in adata.items():
         os.makedirs(join(args.output_dir, 'regions', region), exist_ok=True)
-        data.save(join(args.output_dir, 'regions', region, 'demultiplexed.qza'))
+        save_artifact(data, join(args.output_dir, 'regions', region, 'demultiplexed.qza'))
+
+    for name, data in (region_data or {}).items():
+        for region, artifact in data.items():
+            os.makedirs(join(args.output_dir, 'regions', region), exist_ok=True)
+            save_artifact(artifact, join(args.output_dir, 'regions', region, name))
 
     for region, data in denoise_viz_region.items():
         for name, viz in data.items():
@@ -469,6 +1342,17 @@ if __name__ == '__main__':
     parser = get_parser()
     args = parser.parse_args()
     args.classifier_dir  = os.path.abspath(args.classifier_dir)
+    if (args.dereplicate or args.per_sample) and not args.shared_error_model:
+        write_message('--dereplicate/--per-sample denoise with shared error models, enabling --shared-error-model')
+        args.shared_error_model = True
+    if args.classifier_cache_dir is None:
+        args.classifier_cache_dir = join(args.classifier_dir, 'cache')
+    if args.taxonomy_cache is None:
+        args.taxonomy_cache = join(args.classifier_cache_dir, 'taxonomy.sqlite')
+    elif args.taxonomy_cache == 'None':
+        args.taxonomy_cache = None
+    if args.taxonomy_cache is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(args.taxonomy_cache)), exist_ok=True)
     PRIMERS = available_primers(args.libprep_config)
     if args.libprep in PRIMERS:
         all_primers = PRIMERS[args.libprep]
@@ -501,12 +1385,22 @@ if __name__ == '__main__':
     write_message('loading sample info')
     samples = Metadata.load(os.path.abspath(args.sample_info))
 
+    os.makedirs(args.output_dir, exist_ok=True)
+    atexit.register(write_profile, args.output_dir)
     write_message('starting demultiplex fastq files')
     # adata key: region, value: SampleData[PairedEndSequencesWithQuality] artifact
-    adata = demultiplex_manifests(args.input, primers, args.regions, split_on_header=True, threads=args.threads)
+    R1 = [i for i in args.input if '_R1.fastq' in i]
+    demux_key = stage_key(file_signature(R1 + [i.replace('_R1.fastq', '_R2.fastq') for i in R1]), primers,
+                          args.regions, args.filter_region_count)
+    res = run_stage('demultiplex', demux_key, lambda: dict(zip(['adata', 'read_counts'], demultiplex_manifests(
+        args.input, args.regions, min_count=args.filter_region_count, threads=args.threads,
+        compress_level=args.compress_level))))
+    adata, read_counts = res['adata'], res['read_counts']
     write_message('completed demultiplex fastq files')
     write_message('starting read count of fastq files')
-    counts, merged_counts = sequence_counts(adata, min_count=args.filter_region_count )
+    with profile('count'):
+        read_counts.to_csv(join(args.output_dir, 'region_read_counts.tsv'), sep='\t')
+        counts, merged_counts = sequence_counts(read_counts, min_count=args.filter_region_count)
     # filter regions with too few reads
     for k in list(adata.keys()):
         if not k in counts:
@@ -515,51 +1409,127 @@ if __name__ == '__main__':
 
 
     DADA2_PARAMS = dada2_denoise_params(args.libprep_config, args.libprep)
+    if args.pooling_method:
+        DADA2_PARAMS['pooling_method'] = args.pooling_method
+    elif args.per_sample:
+        DADA2_PARAMS['pooling_method'] = 'pseudo'
+    if args.per_sample and DADA2_PARAMS.get('pooling_method') == 'pooled':
+        raise ValueError('--per-sample denoising supports pseudo or independent pooling, not pooled')
     # denoise dada2
     write_message('starting denoising (dada2)')
-    tables, sequences, stats = denoise_dada2(adata, threads=args.threads, **DADA2_PARAMS)
+    error_model, run_ids = None, {}
+    if args.shared_error_model:
+        run_ids = fastq_run_ids(R1)
+        if args.run_id:
+            run_ids = {s: args.run_id for s in run_ids}
+        error_model_dir = args.error_model_dir or join(args.output_dir, 'error_models')
+        error_model = shared_error_models(adata, run_ids, error_model_dir, args.output_dir, threads=args.threads,
+                                          **DADA2_PARAMS)
+        if error_model is None and (args.dereplicate or args.per_sample):
+            raise ValueError('--dereplicate/--per-sample need the sequencing run of all samples, no run id found in fastq headers (use --run-id)')
+        if error_model is None:
+            write_message('no run id found in fastq headers, learning error models per region')
+        elif len(set(run_ids.values())) > 1:
+            write_message('learned error models of {} sequencing runs'.format(len(set(run_ids.values()))))
+    denoise_key = stage_key(demux_key, sorted(adata.keys()), DADA2_PARAMS, error_model,
+                            sorted(run_ids.items()) if error_model else None, args.dereplicate, args.per_sample)
+    res = run_stage('denoise', denoise_key, lambda: dict(zip(['tables', 'sequences', 'stats'], denoise_dada2(
+        adata, read_counts=read_counts, threads=args.threads, error_model=error_model, dereplicate=args.dereplicate,
+        per_sample=args.per_sample, **DADA2_PARAMS))))
+    tables, sequences, stats = res['tables'], res['sequences'], res['stats']
     write_message('completed denoising (dada2)')
 
-    write_message('starting summary of dada2')
-    denoise_viz_region = dada2_summary(tables, sequences, stats)
-    write_message('completed summary of dada2')
+    denoise_viz_region = {}
+    if not args.skip_summaries:
+        write_message('starting summary of dada2')
+        denoise_viz_region = dada2_summary(tables, sequences, stats)
+        write_message('completed summary of dada2')
     # classify sequences
     write_message('starting taxonomy classification')
-    taxas = taxonomy_classify(sequences, args.classifier_dir, primers, level=args.classifier_level, threads=4)
+    classify_key = stage_key(denoise_key, args.classifier_dir, args.classifier_level,
+                             {r: classifier_identity(join(args.classifier_dir, '{}_{}'.format(args.classifier_level, primers[r])))
+                              for r in sequences.keys()})
+    taxas = run_stage('classify', classify_key, lambda: {'taxas': taxonomy_classify(
+        sequences, args.classifier_dir, primers, level=args.classifier_level, cache_dir=args.classifier_cache_dir,
+        taxonomy_cache=args.taxonomy_cache, partial_dir=join(args.output_dir, 'stage_cache', 'classify_partial'),
+        memory_gb=args.classify_memory, threads=args.threads)})['taxas']
     write_message('completed taxonomy classification')
-    write_message('starting taxonomy summary')
-    taxa_viz_region = taxonomy_summary(taxas, tables, samples)
-    write_message('completed taxonomy summary')
+    taxa_viz_region = {}
+    if not args.skip_summaries:
+        write_message('starting taxonomy summary')
+        taxa_viz_region = taxonomy_summary(taxas, tables, samples)
+        write_message('completed taxonomy summary')
     # merge data
     write_message('merging data')
-    table, taxonomy, sequence, meta_region = merge_data(tables, taxas, sequences, samples)
+    merge_key = stage_key(classify_key)
+    res = run_stage('merge', merge_key, lambda: dict(zip(['table', 'taxonomy', 'sequence', 'meta_region'], merge_data(
+        tables, taxas, sequences, samples))))
+    table, taxonomy, sequence, meta_region = res['table'], res['taxonomy'], res['sequence'], res['meta_region']
     write_message('merging completed')
 
+    # add run to project data
+    project_dir = join(args.output_dir, 'project')
+    project = load_project(project_dir) if args.incremental else None
+    runs = [merge_key]
+    if project is not None:
+        if merge_key in project['runs']:
+            write_message('run already merged into project')
+            runs = project['runs']
+            table, taxonomy, sequence, meta_region = [project[k] for k in ['table', 'taxonomy', 'sequence', 'meta_region']]
+            samples = project['samples']
+        else:
+            write_message('merging run into project of {} runs'.format(len(project['runs'])))
+            with profile('project_merge'):
+                table, taxonomy, sequence, meta_region, samples = merge_project(
+                    project, table, taxonomy, sequence, meta_region, samples, overlap_method=args.overlap_method)
+            runs = project['runs'] + [merge_key]
+    if args.incremental and (project is None or runs != project['runs']):
+        with profile('project_save'):
+            save_project(project_dir, table, taxonomy, sequence, meta_region, samples, runs)
+
     # filter features
     write_message('filtering features')
-    table, taxonomy, sequence = filter_features(table, taxonomy, sequence, db=args.taxonomy_db, min_confidence=args.min_confidence)
+    filter_key = stage_key(runs, args.taxonomy_db, args.min_confidence)
+    res = run_stage('filter', filter_key, lambda: dict(zip(['table', 'taxonomy', 'sequence'], filter_features(
+        table, taxonomy, sequence, db=args.taxonomy_db, min_confidence=args.min_confidence))))
+    table, taxonomy, sequence = res['table'], res['taxonomy'], res['sequence']
     write_message('filtering features completed')
 
     # table summaries
-    write_message('table summaries')
-    summary = summary_data(table, taxonomy, sequence, samples)
+    summary = {}
+    if not args.skip_summaries:
+        write_message('table summaries')
+        with profile('summary'):
+            summary = summary_data(table, taxonomy, sequence, samples)
 
     # biom data
     write_message('create biom')
-    biom_table = create_biom(table, taxonomy, sequence, features_meta=meta_region, samples_meta=samples)
+    with profile('biom'):
+        biom_table = create_biom(table, taxonomy, sequence, features_meta=meta_region, samples_meta=samples)
     write_message('create biom completed')
 
     # diversity
-    # diversity_region = calc_diversity_region(tables, sample_meta=samples, max_depth=5000)
+    diversity_region = {}
+    if args.region_rarefaction:
+        write_message('alpha rarefaction of regions')
+        diversity_region = calc_diversity_region(tables, threads=args.threads)
     write_message('writing files to disk')
-    write_data(table, taxonomy, sequence, adata, biom_table, denoise_viz_region, taxa_viz_region, summary)
+    with profile('write'):
+        region_data = {'table': tables, 'sequence': sequences, 'stats': stats, 'taxonomy': taxas}
+        write_data(table, taxonomy, sequence, adata, biom_table, denoise_viz_region, taxa_viz_region, summary,
+                   region_data=region_data)
+        for region, res in diversity_region.items():
+            write_rarefaction(res, join(args.output_dir, 'alpha_rarefaction', region))
     write_message('completed writing files to disk')
 
     # phylogenetic tree
     if args.build_tree:
         write_message('building phylogenetic tree')
-        tree = build_phylogenetic_tree(sequence, threads=args.threads)
-        tree.rooted_tree.save(join(args.output_dir, 'tree'))
+        tree_reference_dir = args.tree_reference_dir or join(args.output_dir, 'tree_reference')
+        tree = run_stage('tree', stage_key(filter_key, args.rebuild_tree), lambda: {'tree': update_phylogenetic_tree(
+            sequence, tree_reference_dir, threads=args.threads, rebuild=args.rebuild_tree)})['tree']
+        with profile('write_tree'):
+            tree.save(join(args.output_dir, 'tree'))
         write_message('completed phylogenetic tree')
 
     write_message('run_qiime2 completed!')
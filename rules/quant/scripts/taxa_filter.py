@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Taxonomy based feature filtering with per reference database rule sets.
+
+Rules are evaluated once per unique taxonomy string and broadcast to all features.
+"""
+import re
+import argparse
+
+import pandas as pd
+
+RULE_SETS = {
+    'silva': {
+        'ranks': ['D_0__', 'D_1__', 'D_2__', 'D_3__', 'D_4__', 'D_5__', 'D_6__'],
+        'required_ranks': ['D_1__'],
+        'exclude': ['chloroplast', 'mitochondria'],
+        'clean': ['Ambiguous_taxa', r'D_\d__unidentified'],
+    },
+    'greengenes': {
+        'ranks': ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__'],
+        'required_ranks': ['p__'],
+        'exclude': ['chloroplast', 'mitochondria'],
+        'clean': [r'[a-z]__unidentified'],
+    },
+    'unite': {
+        'ranks': ['k__', 'p__', 'c__', 'o__', 'f__', 'g__', 's__'],
+        'required_ranks': ['p__'],
+        'exclude': ['chloroplast', 'mitochondria'],
+        'clean': [r'[a-z]__unidentified'],
+    },
+}
+
+
+def parse_taxonomy(taxon, ranks):
+    """Split taxonomy strings into ranks.
+
+    Returns the taxonomy as a categorical and a dataframe of unique taxonomy strings (rows, in category order)
+    x ranks, with rank prefixes identifying the columns.
+    """
+    taxon = taxon.astype('category')
+    uniq = pd.Series(taxon.cat.categories)
+    split = uniq.str.split(';')
+    R = pd.DataFrame(index=uniq.index, columns=ranks, dtype=object)
+    for rank in ranks:
+        R[rank] = split.map(lambda x: next((t.strip() for t in x if t.strip().startswith(rank)), None))
+    return taxon, R
+
+
+def taxonomy_mask(taxonomy, db, min_confidence=None, include=None, exclude=None, required_ranks=True):
+    """Evaluate the rule set of `db` on a taxonomy dataframe (columns Taxon, Confidence).
+
+    `include` and `exclude` are lists of case-insensitive terms to match anywhere in the taxonomy, the
+    `exclude` terms of the rule set are always used. Features without the required ranks of the rule set are
+    removed if `required_ranks` is set. Returns a boolean keep mask and the cleaned taxonomy strings.
+    """
+    if db not in RULE_SETS:
+        raise ValueError('taxonomy db {} is not supported!'.format(db))
+    rules = RULE_SETS[db]
+    taxon, R = parse_taxonomy(taxonomy['Taxon'], rules['ranks'])
+    uniq = pd.Series(taxon.cat.categories)
+
+    keep = pd.Series(True, index=uniq.index)
+    for rank in (rules['required_ranks'] if required_ranks else []):
+        keep &= R[rank].notnull()
+    exclude = list(rules['exclude']) + list(exclude or [])
+    if exclude:
+        keep &= ~uniq.str.contains('|'.join(map(re.escape, exclude)), flags=re.IGNORECASE)
+    if include:
+        keep &= uniq.str.contains('|'.join(map(re.escape, include)), flags=re.IGNORECASE)
+    cleaned = uniq
+    for patt in rules['clean']:
+        cleaned = cleaned.str.replace(patt, '', regex=True)
+
+    codes = taxon.cat.codes.values
+    mask = pd.Series(keep.values[codes], index=taxonomy.index)
+    if min_confidence is not None:
+        mask &= taxonomy['Confidence'].astype('d') >= min_confidence
+    cleaned = pd.Series(cleaned.values[codes], index=taxonomy.index, name='Taxon')
+    return mask, cleaned
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='filter qiime2 feature table on taxonomy',
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--table', help='FeatureTable[Frequency] artifact', required=True)
+    parser.add_argument('--taxonomy', help='FeatureData[Taxonomy] artifact', required=True)
+    parser.add_argument('--taxonomy-db', help='reference database', choices=list(RULE_SETS.keys()), required=True)
+    parser.add_argument('--min-confidence', help='minimum accepted classifier confidence', type=float)
+    parser.add_argument('--include', help='comma separated list of terms, features must match at least one')
+    parser.add_argument('--exclude', help='comma separated list of terms, features matching any are removed')
+    parser.add_argument('--no-required-ranks', help='keep features without the required ranks of the rule set (e.g. phylum)',
+                        action='store_true')
+    parser.add_argument('--output', help='filtered FeatureTable[Frequency] artifact', required=True)
+    return parser
+
+
+if __name__ == '__main__':
+    import biom
+    from qiime2 import Artifact
+
+    args = get_parser().parse_args()
+    T = Artifact.load(args.table).view(biom.Table)
+    X = Artifact.load(args.taxonomy).view(pd.DataFrame)
+    X = X.loc[X.index.isin(T.ids('observation'))]
+    include = args.include.split(',') if args.include else None
+    exclude = args.exclude.split(',') if args.exclude else None
+    keep, _ = taxonomy_mask(X, args.taxonomy_db, min_confidence=args.min_confidence, include=include, exclude=exclude,
+                            required_ranks=not args.no_required_ranks)
+    T = T.filter(X.index[keep], axis='observation', inplace=False)
+    Artifact.import_data('FeatureTable[Frequency]', T).save(args.output)